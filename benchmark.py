@@ -0,0 +1,461 @@
+"""
+An offline benchmark for the bot. Needs no Discord token, no model and no GPU.
+
+Sends synthetic mentions to the chat handler and synthetic /imagine commands to the imagine handler
+at a fixed rate. Discord is replaced by a fake REST client with Discord's edit rate limit, the
+Stable Diffusion API by the fake_sd_server and the LLM by a mock that sleeps per token.
+Reports the p50/p95/p99 latency, the throughput and the memory of the run.
+
+Usage:
+    python benchmark.py --duration 60 --chat-rate 0.5 --image-rate 0.1
+    python benchmark.py --model Model/tiny.bin --json results.json
+"""
+from aiohttp import web
+from collections import deque
+from fake_sd_server import FakeSDServer
+
+import argparse
+import asyncio
+import ctypes
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+import zlib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BOT_ID = 820739005103472691  # The mention the chat handler removes from the message
+DARKART_CHANNEL = 1
+MOCK_ANSWER = "I am a mock model and this answer only exists to measure how fast the bot can deliver it to Discord".split()
+
+class MockLlamaState:
+    def __init__(self, eval_tokens, eval_logits, llama_state, llama_state_size):
+        self.eval_tokens = eval_tokens
+        self.eval_logits = eval_logits
+        self.llama_state = llama_state
+        self.llama_state_size = llama_state_size
+
+class MockLlama:
+    """
+    Behaves like llama_cpp.Llama for the bot, but only sleeps instead of running a model.
+    Evaluating a prompt token takes DARKAI_BENCHMARK_PROMPT_SECONDS, generating a token DARKAI_BENCHMARK_TOKEN_SECONDS.
+    Tokens the model already evaluated are reused like in llama.cpp.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = 512, **kwargs):
+        self.model_path = model_path
+        self.params = types.SimpleNamespace(n_ctx=n_ctx)
+        self.ctx = None
+        self.eval_tokens = deque(maxlen=n_ctx)
+        self.eval_logits = deque(maxlen=1)
+        self.prompt_seconds = float(os.environ.get("DARKAI_BENCHMARK_PROMPT_SECONDS", "0.002"))
+        self.token_seconds = float(os.environ.get("DARKAI_BENCHMARK_TOKEN_SECONDS", "0.05"))
+        self.answer_tokens = int(os.environ.get("DARKAI_BENCHMARK_ANSWER_TOKENS", "20"))
+
+    def tokenize(self, text: bytes) -> list[int]:
+        # One token per word plus the BOS token
+        return [1] + [zlib.crc32(word) % 32000 + 2 for word in text.split()]
+
+    def reset(self) -> None:
+        self.eval_tokens.clear()
+
+    def eval(self, tokens: list[int]) -> None:
+        time.sleep(len(tokens) * self.prompt_seconds)
+        self.eval_tokens.extend(tokens)
+
+    def save_state(self) -> MockLlamaState:
+        return MockLlamaState(self.eval_tokens.copy(), self.eval_logits.copy(), (ctypes.c_uint8 * 1)(), 1)
+
+    def load_state(self, state: MockLlamaState) -> None:
+        self.eval_tokens = state.eval_tokens.copy()
+
+    def __call__(self, prompt: str, stream: bool = True, max_tokens: int = 16, **kwargs):
+        tokens = self.tokenize(prompt.encode("utf-8"))
+        reused = 0
+        for evaluated, token in zip(self.eval_tokens, tokens):
+            if evaluated != token:
+                break
+            reused += 1
+        self.eval_tokens = deque(tokens[:reused], maxlen=self.params.n_ctx)
+        self.eval(tokens[reused:])
+
+        for index in range(min(max_tokens, self.answer_tokens)):
+            time.sleep(self.token_seconds)
+            yield {"choices": [{"text": f" {MOCK_ANSWER[index % len(MOCK_ANSWER)]}"}]}
+
+def install_mock_llama() -> None:
+    """
+    Replaces llama_cpp with the mock. Also runs in the LLM worker processes, they import this file first.
+    """
+    module = types.ModuleType("llama_cpp")
+    module.Llama = MockLlama
+    module.llama_set_rng_seed = lambda ctx, seed: None
+    module.llama_get_state_size = lambda ctx: 1
+    module.llama = types.ModuleType("llama_cpp.llama")
+    module.llama.Llama = MockLlama
+    module.llama.LlamaState = MockLlamaState
+    sys.modules["llama_cpp"] = module
+    sys.modules["llama_cpp.llama"] = module.llama
+
+if "DARKAI_BENCHMARK_MODEL" not in os.environ:
+    install_mock_llama()
+
+class FakeRest:
+    """
+    Records the messages the bot sends and edits.
+    Every call takes 'latency' seconds, and a channel allows 5 edits per 5 seconds like Discord.
+    """
+
+    def __init__(self, latency: float, rate_limit: bool):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.edits = 0
+        self.rate_limit_waits = []
+        self.first_text_at = {}  # Message ID -> time the first edit with answer text arrived
+        self.reacted_at = {}  # Message ID -> time the bot added the reaction
+        self._message_ids = itertools.count(1)
+        self._buckets = {}
+
+    async def create_message(self, channel_id: int, content: str) -> "FakeMessage":
+        await asyncio.sleep(self.latency)
+        return FakeMessage(self, channel_id, next(self._message_ids), content)
+
+    async def edit_message(self, channel_id: int, message_id: int, content: str) -> "FakeMessage":
+        if self.rate_limit:
+            bucket = self._buckets.setdefault(channel_id, deque(maxlen=5))
+            if len(bucket) == 5 and time.monotonic() - bucket[0] < 5:
+                wait = 5 - (time.monotonic() - bucket[0])
+                self.rate_limit_waits.append(wait)
+                await asyncio.sleep(wait)
+            bucket.append(time.monotonic())
+
+        await asyncio.sleep(self.latency)
+        self.edits += 1
+        # Status messages are not part of the answer
+        if not content.startswith(("You are #", "I am too busy", "Your message contains")):
+            self.first_text_at.setdefault(message_id, time.monotonic())
+        return FakeMessage(self, channel_id, message_id, content)
+
+    async def delete_message(self, channel_id: int, message_id: int) -> None:
+        await asyncio.sleep(self.latency)
+
+    async def fetch_channel(self, channel_id: int) -> "FakeChannel":
+        await asyncio.sleep(self.latency)
+        return FakeChannel(self, channel_id)
+
+class FakeMessage:
+    """
+    A Discord message. Remembers the answers it got.
+    """
+
+    def __init__(self, rest: FakeRest, channel_id: int, message_id: int, content: str):
+        self.rest = rest
+        self.channel_id = channel_id
+        self.id = message_id
+        self.content = content
+        self.responses = []
+
+    async def respond(self, content: str) -> "FakeMessage":
+        response = await self.rest.create_message(self.channel_id, content)
+        self.responses.append(response)
+        return response
+
+    async def add_reaction(self, emoji: str) -> None:
+        await asyncio.sleep(self.rest.latency)
+        self.rest.reacted_at[self.id] = time.monotonic()
+
+class FakeChannel:
+    def __init__(self, rest: FakeRest, channel_id: int):
+        self.rest = rest
+        self.id = channel_id
+
+    async def send(self, content) -> FakeMessage:
+        return await self.rest.create_message(self.id, str(content))
+
+class FakeUser:
+    def __init__(self, rest: FakeRest, user_id: int):
+        self.rest = rest
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.discriminator = "0000"
+
+    async def send(self, content) -> FakeMessage:
+        return await self.rest.create_message(self.id, str(content))
+
+def make_mention(rest: FakeRest, number: int, users: int, channels: int) -> types.SimpleNamespace:
+    """
+    Builds a GuildMessageCreateEvent that mentions the bot.
+    """
+    author = FakeUser(rest, 1000 + number % users)
+    channel_id = 100 + number % channels
+    message = FakeMessage(rest, channel_id, 10_000_000 + number, f"<@{BOT_ID}> What do you think about benchmark number {number}?")
+    message.user_mentions_ids = [BOT_ID]
+    return types.SimpleNamespace(is_human=True, message=message, author=author, channel_id=channel_id, message_id=message.id, app=types.SimpleNamespace(rest=rest))
+
+class FakeSlashContext:
+    """
+    The parts of lightbulb.SlashContext the /imagine command uses.
+    """
+
+    def __init__(self, rest: FakeRest, number: int, users: int, options: dict):
+        self.channel_id = DARKART_CHANNEL
+        self.author = FakeUser(rest, 1000 + number % users)
+        self.options = types.SimpleNamespace(**options)
+        self.bot = types.SimpleNamespace(rest=rest)
+        self.rest = rest
+
+    async def respond(self, content: str, flags=None) -> FakeMessage:
+        return await self.rest.create_message(self.channel_id, content)
+
+def percentiles(values: list[float]) -> dict:
+    """
+    Returns the p50, p95 and p99 of the values.
+    """
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    values = sorted(values)
+    return {f"p{percent}": values[min(len(values) - 1, int(len(values) * percent / 100))] for percent in (50, 95, 99)}
+
+def peak_rss_mb() -> float | None:
+    """
+    Returns the peak memory of the bot process. LLM worker processes are not included.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def configure(args: argparse.Namespace, model_path: str, sd_url: str) -> None:
+    """
+    Points the config of the bot at the fakes. Must run before bot.py is imported.
+    """
+    import config
+
+    threads = min(os.cpu_count() or 1, max(args.workers, args.threads))
+    config.apply_config(dict(config.config, **{
+        "Model Path": model_path,
+        "Model Workers": args.workers,
+        "Number of Threads": threads,
+        "Deterministic": False,
+        "SD API URL": sd_url,
+        "Darkart Channel": DARKART_CHANNEL,
+        "Image Cache Size": 0,
+        "Metrics Port": 0,
+    }))
+    if args.max_image_wait is not None:
+        config.apply_config(dict(config.config, **{"Max Image Wait": args.max_image_wait}))
+
+async def run_load(rate: float, duration: float, send) -> list[asyncio.Task]:
+    """
+    Starts 'send(number)' 'rate' times per second for 'duration' seconds, without waiting for the answers.
+    """
+    tasks = []
+    if rate <= 0:
+        return tasks
+    started_at = time.monotonic()
+    for number in itertools.count():
+        send_at = started_at + number / rate
+        if send_at - started_at >= duration:
+            return tasks
+        await asyncio.sleep(max(send_at - time.monotonic(), 0))
+        tasks.append(asyncio.create_task(send(number)))
+
+async def benchmark(args: argparse.Namespace) -> dict:
+    """
+    Runs the benchmark in a temporary folder, which is removed afterwards together with the histories and images the bot wrote.
+    """
+    original_folder = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="darkai-benchmark-") as work_folder:
+        os.chdir(work_folder)
+        try:
+            return await run_benchmark(args, work_folder)
+        finally:
+            # Windows can not remove the folder while it is the working directory
+            os.chdir(original_folder)
+
+async def run_benchmark(args: argparse.Namespace, work_folder: str) -> dict:
+    os.makedirs("chathistory+", exist_ok=True)
+
+    model_path = args.model
+    if model_path is None:
+        model_path = os.path.join(work_folder, "mock-model.bin")
+        with open(model_path, "wb"):
+            pass
+
+    # The fake Stable Diffusion API
+    sd_server = FakeSDServer(args.seconds_per_step)
+    sd_runner = web.AppRunner(sd_server.app())
+    await sd_runner.setup()
+    site = web.TCPSite(sd_runner, "127.0.0.1", 0)
+    await site.start()
+    sd_port = sd_runner.addresses[0][1]
+
+    configure(args, model_path, f"http://127.0.0.1:{sd_port}")
+
+    import bot
+    from metrics import CHAT_PROMPT_EVAL
+    from metrics import CHAT_REQUESTS
+    from metrics import CHAT_TOKENS_PER_SECOND
+    from metrics import SD_QUEUE_WAIT
+
+    if not args.log:
+        logging.getLogger("darkai").setLevel(logging.WARNING)
+        logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    rest = FakeRest(args.rest_latency, not args.no_rate_limit)
+    # The bot never logs in, so it does not know its own user
+    type(bot.bot).get_me = lambda self: types.SimpleNamespace(id=BOT_ID)
+
+    load_started_at = time.monotonic()
+    await bot.on_starting(None)
+    # The overrides above are not in the config.yml, a reload would undo them
+    bot.bot.d.config_task.cancel()
+    await bot.bot.d.warm_up_task
+    model_load_time = time.monotonic() - load_started_at
+    if not bot.startup.ready:
+        raise RuntimeError(f"The chat could not be started: {bot.startup.error}")
+
+    chat_latencies = []
+    chat_first_text = []
+    image_latencies = []
+
+    async def send_chat(number: int) -> None:
+        event = make_mention(rest, number, args.users, args.channels)
+        sent_at = time.monotonic()
+        await bot.chat(event)
+
+        # Only answers that got the reaction were completed
+        answer_id = event.message.responses[0].id if event.message.responses else None
+        if answer_id in rest.reacted_at:
+            chat_latencies.append(rest.reacted_at[answer_id] - sent_at)
+            if answer_id in rest.first_text_at:
+                chat_first_text.append(rest.first_text_at[answer_id] - sent_at)
+
+    async def send_imagine(number: int) -> None:
+        context = FakeSlashContext(rest, number, args.users, {
+            "prompt": f"benchmark image {number}",
+            "steps": args.image_steps,
+            "width": args.image_size,
+            "height": args.image_size,
+            "private": False,
+            "negative_prompt": None,
+            "seed": -1,
+        })
+        sent_at = time.monotonic()
+        await bot.imagine_command.callback(context)
+        image_latencies.append(time.monotonic() - sent_at)
+
+    started_at = time.monotonic()
+    load = await asyncio.gather(run_load(args.chat_rate, args.duration, send_chat), run_load(args.image_rate, args.duration, send_imagine))
+    tasks = load[0] + load[1]
+    _, unfinished = await asyncio.wait(tasks, timeout=args.drain_timeout) if tasks else (set(), set())
+    for task in unfinished:
+        task.cancel()
+    elapsed = time.monotonic() - started_at
+
+    await bot.on_stopping(None)
+    background_tasks = (bot.bot.d.history_task, bot.bot.d.image_queue_task, bot.bot.d.image_archiver_task)
+    for task in background_tasks:
+        task.cancel()
+    # Nothing may write into the work folder anymore when it is removed
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await sd_runner.cleanup()
+
+    return {
+        "settings": {key: value for key, value in vars(args).items() if key != "json"},
+        "elapsed": elapsed,
+        "model_load_time": model_load_time,
+        "chat": {
+            "sent": len(load[0]),
+            "answered": len(chat_latencies),
+            "results": {dict(key).get("result"): value for key, value in CHAT_REQUESTS.values.items()},
+            "latency": percentiles(chat_latencies),
+            "first_text": percentiles(chat_first_text),
+            "throughput": len(chat_latencies) / elapsed,
+            "average_prompt_eval": CHAT_PROMPT_EVAL.average(),
+            "average_tokens_per_second": CHAT_TOKENS_PER_SECOND.average(),
+            "discord_edits": rest.edits,
+            "rate_limit_waits": len(rest.rate_limit_waits),
+            "rate_limit_wait_time": sum(rest.rate_limit_waits),
+        },
+        "imagine": {
+            "sent": len(load[1]),
+            "answered": len(image_latencies),
+            "latency": percentiles(image_latencies),
+            "queue_wait": {f"p{percent}": SD_QUEUE_WAIT.percentile(percent) if SD_QUEUE_WAIT.count() else None for percent in (50, 95, 99)},
+            "throughput": len(image_latencies) / elapsed,
+            "txt2img_calls": sd_server.requests["txt2img"],
+        },
+        "memory": {"peak_rss_mb": peak_rss_mb()},
+    }
+
+def format_report(results: dict) -> str:
+    def seconds(values: dict) -> str:
+        return " | ".join(f"{name} {'-' if value is None else f'{value:.2f}s'}" for name, value in values.items())
+
+    chat = results["chat"]
+    imagine = results["imagine"]
+    peak_rss = results["memory"]["peak_rss_mb"]
+    return "\n".join([
+        f"Run: {results['elapsed']:.1f}s, model loaded in {results['model_load_time']:.2f}s",
+        f"Chat: {chat['answered']}/{chat['sent']} answered {chat['results']}, {chat['throughput']:.2f}/s",
+        f"  Latency:    {seconds(chat['latency'])}",
+        f"  First text: {seconds(chat['first_text'])}",
+        f"  Prompt eval {chat['average_prompt_eval']:.2f}s | {chat['average_tokens_per_second']:.1f} tokens/s",
+        f"  Discord edits: {chat['discord_edits']} | Rate limited: {chat['rate_limit_waits']} ({chat['rate_limit_wait_time']:.1f}s)",
+        f"Imagine: {imagine['answered']}/{imagine['sent']} sent in {imagine['txt2img_calls']} txt2img calls, {imagine['throughput']:.2f}/s",
+        f"  Latency:    {seconds(imagine['latency'])}",
+        f"  Queue wait: {seconds(imagine['queue_wait'])}",
+        f"Peak memory: {'-' if peak_rss is None else f'{peak_rss:.0f} MB'} (bot process)",
+    ])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the chat and /imagine handlers without Discord, a model or a GPU.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds new requests are sent")
+    parser.add_argument("--chat-rate", type=float, default=0.5, help="Mentions per second")
+    parser.add_argument("--image-rate", type=float, default=0.1, help="/imagine commands per second")
+    parser.add_argument("--users", type=int, default=20, help="Different users sending requests")
+    parser.add_argument("--channels", type=int, default=4, help="Different channels the mentions are sent in")
+    parser.add_argument("--workers", type=int, default=1, help="Overrides 'Model Workers'")
+    parser.add_argument("--threads", type=int, default=1, help="Overrides 'Number of Threads'")
+    parser.add_argument("--model", help="Uses a real (tiny) model instead of the mock")
+    parser.add_argument("--token-seconds", type=float, default=0.05, help="Mock: seconds per generated token")
+    parser.add_argument("--prompt-seconds", type=float, default=0.002, help="Mock: seconds per evaluated prompt token")
+    parser.add_argument("--answer-tokens", type=int, default=20, help="Mock: tokens per answer")
+    parser.add_argument("--rest-latency", type=float, default=0.05, help="Seconds per Discord REST call")
+    parser.add_argument("--no-rate-limit", action="store_true", help="Disables the Discord edit rate limit")
+    parser.add_argument("--seconds-per-step", type=float, default=0.05, help="Fake SD API: generation time per step and megapixel")
+    parser.add_argument("--image-steps", type=int, default=15)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--max-image-wait", type=float, help="Overrides 'Max Image Wait'")
+    parser.add_argument("--drain-timeout", type=float, default=300, help="Seconds to wait for the answers after the last request")
+    parser.add_argument("--json", help="Also writes the results to this file")
+    parser.add_argument("--log", action="store_true", help="Shows the structured logs of the bot")
+    args = parser.parse_args()
+    if args.json is not None:
+        args.json = os.path.abspath(args.json)
+
+    # Inherited by the LLM worker processes
+    os.environ["DARKAI_BENCHMARK_TOKEN_SECONDS"] = str(args.token_seconds)
+    os.environ["DARKAI_BENCHMARK_PROMPT_SECONDS"] = str(args.prompt_seconds)
+    os.environ["DARKAI_BENCHMARK_ANSWER_TOKENS"] = str(args.answer_tokens)
+    if args.model is not None:
+        args.model = os.path.abspath(args.model)
+        os.environ["DARKAI_BENCHMARK_MODEL"] = args.model
+        del sys.modules["llama_cpp"], sys.modules["llama_cpp.llama"]
+
+    # bot.py and config.py are imported from here, the benchmark runs in a temporary folder
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    results = asyncio.run(benchmark(args))
+    print(format_report(results))
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=2)
@@ -1,21 +1,62 @@
-from better_profanity import profanity as pf
 from config import BotConfig
 from config import LLMConfig
 from config import SDConfig
+from config import config_path
 from config import validate_config
+from config_watcher import ConfigWatcher
+from conversation_store import ConversationStore
+from conversation_store import HistoryWriter
+from conversation_store import history_file_name
+from conversation_store import read_histories
+from conversation_store import read_history
+from stream_renderer import StreamRenderer
+from chat_scheduler import ChatQueueFullError
+from chat_scheduler import ChatRequestCancelled
+from chat_scheduler import ChatScheduler
 from datetime import datetime
 from llama_cpp import Llama
-from PIL import Image, PngImagePlugin
+from image_archive import ImageArchiver
+from image_archive import add_png_text
+from image_archive import file_name_part
+from image_cache import ImageCache
+from image_queue import ImageJob
+from image_queue import ImageQueue
+from llm_worker import LLMWorkerPool
+from metrics import CHAT_GENERATION
+from metrics import CHAT_PROMPT_EVAL
+from metrics import CHAT_REQUESTS
+from metrics import CHAT_TIME_TO_FIRST_TOKEN
+from metrics import CHAT_TOKENS
+from metrics import CHAT_TOKENS_PER_SECOND
+from metrics import DISCORD_EDIT_DURATION
+from metrics import FILE_IO_DURATION
+from metrics import IMAGE_SEND_DURATION
+from metrics import SD_QUEUE_WAIT
+from metrics import SD_REQUEST_DURATION
+from metrics import log_event
+from metrics import metrics
+from metrics import new_trace_id
+from profanity_filter import profanity as pf
+from response_cache import ResponseCache
+from response_cache import SharedGenerationFailed
+from sd_client import SDAPIError
+from sd_client import SDClient
+from startup import StartupReport
 
 import asyncio
 import base64
-import copy
+import contextlib
+import functools
 import hikari
-import io
+import json
 import lightbulb
-import requests
+import time
 
-validate_config()
+# Measures the startup. The model loads in the background while the bot connects to Discord.
+startup = StartupReport()
+
+with startup.phase("config"):
+    validate_config()
 
 # Logging in the Bot
 bot = lightbulb.BotApp(
@@ -23,9 +64,15 @@ bot = lightbulb.BotApp(
     default_enabled_guilds=(BotConfig.guild)
 )
 
-# Create an instance of the LLM
-llm = Llama(model_path=LLMConfig.model_path, 
-            n_ctx=512,
+def create_llm_pool() -> LLMWorkerPool:
+    """
+    Creates the workers that own the LLM, with the current config. The models are loaded by the workers once the pool starts.
+    """
+    return LLMWorkerPool(workers=LLMConfig.model_workers,
+            prefix=f"{LLMConfig.prompt}\n\n",
+            cache_folder="prompt_cache",
+            model_path=LLMConfig.model_path,
+            n_ctx=LLMConfig.CONTEXT_SIZE,
             seed=LLMConfig.model_seed,
             n_parts=-1,
             f16_kv=True,
@@ -40,52 +87,268 @@ llm = Llama(model_path=LLMConfig.model_path,
             verbose=True,
             )
 
-def log_message(user_name, user_prompt, response, dm: bool):
+llm_pool = create_llm_pool()
+
+# The config settings that need a new LLM pool, and the ones that only take effect after a restart
+MODEL_CONFIG_KEYS = {"Model Path", "Number of Threads", "Model Workers", "Deterministic", "Model Seed"}
+RESTART_CONFIG_KEYS = {"Bot Token", "Guild ID", "Admin Role", "Max Prompt Length", "Metrics Port"}
+
+# Orders the chat requests before they reach the LLM
+chat_scheduler = ChatScheduler(max_pending=LLMConfig.max_queued_chats,
+                               max_per_user=LLMConfig.max_queued_chats_per_user,
+                               max_per_channel=LLMConfig.max_queued_chats_per_channel,
+                               concurrency=LLMConfig.model_workers,
+                               )
+
+@functools.lru_cache(maxsize=2)
+def get_tokenizer(model_path: str) -> Llama:
+    """
+    Loads the vocabulary of the LLM on first use. Used to count the tokens of the chat history.
+    """
+    return Llama(model_path=model_path, vocab_only=True, verbose=False)
+
+def count_tokens(text: str) -> int:
+    """
+    Returns the amount of LLM tokens in the text, including the BOS token.
+    Uses the vocabulary of the model that is currently answering.
+    """
+    return len(get_tokenizer(llm_pool.model_path).tokenize(text.encode("utf-8")))
+
+# The chat history of every channel and DM. The saved history is read once the bot starts.
+conversation_store = ConversationStore(count_tokens, max_lines=LLMConfig.chat_memory_length, default_history=LLMConfig.default_chat_history)
+history_writer = HistoryWriter()
+
+# The connection pool for the Stable Diffusion API
+sd_client = SDClient(url=BotConfig.url, timeout=SDConfig.timeout, retries=SDConfig.retries)
+
+# Queues the /imagine requests and generates identical ones in one batch
+image_queue = ImageQueue(sd_client.txt2img,
+                         max_concurrent=SDConfig.max_concurrent_jobs,
+                         batch_window=SDConfig.batch_window,
+                         max_batch_size=SDConfig.max_batch_size,
+                         )
+
+# Saves the generated images in the background
+image_archiver = ImageArchiver()
+
+# Keeps the images with a fixed seed to answer repeated requests
+image_cache = ImageCache("image_cache", max_bytes=SDConfig.cache_size * 1024 ** 2)
+
+MAX_ANSWER_TOKENS = 100  # Max tokens of a chat answer
+
+# Caches the answers in deterministic mode
+response_cache = ResponseCache(max_entries=LLMConfig.response_cache_size, ttl=LLMConfig.response_cache_ttl)
+
+# Queue depths and cache sizes are read whenever the metrics are scraped
+metrics.gauge("darkai_chat_queue_pending", "Chat requests waiting for the LLM", lambda: chat_scheduler.stats()["pending"])
+metrics.gauge("darkai_chat_queue_running", "Chat requests the LLM is answering", lambda: chat_scheduler.stats()["running"])
+metrics.gauge("darkai_image_queue_pending", "Images waiting for the Stable Diffusion API", lambda: image_queue.stats()["pending"])
+metrics.gauge("darkai_image_queue_running", "txt2img calls that are running", lambda: image_queue.stats()["running"])
+metrics.gauge("darkai_image_seconds_per_step_megapixel", "Learned speed of the Stable Diffusion API", lambda: image_queue.stats()["seconds_per_step_megapixel"])
+metrics.gauge("darkai_image_cache_bytes", "Size of the image cache", lambda: image_cache.size)
+metrics.gauge("darkai_image_cache_hits", "Images with a fixed seed that were taken from the cache", lambda: image_cache.stats()["hits"])
+metrics.gauge("darkai_image_cache_misses", "Images with a fixed seed that were not in the cache", lambda: image_cache.stats()["misses"])
+metrics.gauge("darkai_response_cache_entries", "Cached chat answers", lambda: response_cache.stats()["entries"])
+metrics.gauge("darkai_chat_ready", "1 once the model is loaded and warmed up", lambda: int(startup.ready))
+
+def build_question(user_name: str, user_prompt: str) -> str:
+    """
+    Returns the end of the prompt with the user's message, after which the LLM answers.
+    """
+    return f"{user_name}: {user_prompt}\n{LLMConfig.ai_name}: "
+
+def build_prompt(conversation_key: tuple, user_name: str, user_prompt: str) -> str:
     """
-    Logs the chat message to a file.
+    Builds the prompt for the LLM.
+    The chat history is trimmed so the prompt and the answer fit into the context of the LLM.
+
+    Args:
+        conversation_key (tuple): The key of the conversation in the conversation store.
+        user_name (str): The username of the sender.
+        user_prompt (str): The user's message.
+    """
+    prefix = f"{LLMConfig.prompt}\n\n"
+    question = build_question(user_name, user_prompt)
+    token_budget = LLMConfig.CONTEXT_SIZE - MAX_ANSWER_TOKENS - count_tokens(prefix) - count_tokens(question)
+    history = conversation_store.render(conversation_key, max(token_budget, 0))
+    return f"{prefix}{history}{question}"
+
+def conversation_path(conversation_key: tuple) -> str:
+    """
+    Returns the path of the short history file of a conversation.
+    """
+    return f"chathistory+/conversations/{history_file_name(conversation_key)}"
+
+def log_message(user_name, user_prompt, response, conversation_key: tuple, trace_id: str | None = None):
+    """
+    Logs the chat message to the conversation store and the chat history files.
+    The files are written in the background by the history writer.
 
     Args:
         user_name (str): The username of the sender.
         user_prompt (str): The user's message.
         response (str): The AI's response.
-        dm (bool): Specifies if the message should be saved to the DM chatlog or the regular Chatlog
+        conversation_key (tuple): The key of the conversation in the conversation store.
+        trace_id (str | None): The ID of the chat request in the logs.
     """
 
     oneline_user_prompt = user_prompt.replace('\n', ' ')
     oneline_response = response.replace('\n', ' ')
+    lines = [f"{user_name}: {oneline_user_prompt}", f"{LLMConfig.ai_name}: {oneline_response}"]
 
-    if dm:
-        with open("chathistory+\complete_dm_chathistory.txt", "a", encoding="utf-8") as complete_dm_file:
-            complete_dm_file.write(f"{user_name}: {oneline_user_prompt}\n{LLMConfig.ai_name}: {oneline_response}\n")
-    
-        with open("chathistory+\complete_dm_chathistory.txt", "r", encoding="utf-8") as complete_dm_file:
-            lines = complete_dm_file.readlines()
-            last_lines = lines[-LLMConfig.chat_memory_length:]
+    conversation_store.add(conversation_key, lines)
+
+    # The complete history is only appended to. Every channel has its own short history.
+    history_writer.append("chathistory+/complete_chathistory.txt", "".join(f"{line}\n" for line in lines))
+    history_writer.replace(conversation_path(conversation_key), conversation_store.render(conversation_key))
+
+    log_event("chat_logged", trace_id, response_length=len(response))
+
+def warm_up_prompt() -> str:
+    """
+    The prompt of the generation that warms up a new model.
+    """
+    return f"{LLMConfig.prompt}\n\nDarkyl: Hello.\n{LLMConfig.ai_name}: "
 
-        with open("chathistory+\dm_chathistory.txt", "w", encoding="utf-8") as dm_file:
-            for line in last_lines:
-                truncated_line = line[:500]  # Limit line length to 500 characters
-                dm_file.write(truncated_line)
+#Loads everything the chat needs in the background
+async def warm_up() -> None:
+    """
+    Loads the profanity list, the chat history, the tokenizer and the LLM at the same time,
+    then generates a single token so the first answer does not pay for reading the model.
+    Mentions get a "warming up" message until this is done.
+    """
+    async def load_history() -> None:
+        #Channels without a saved history continue the shared history of older versions, or start with the default history
+        histories, shared_history = await asyncio.gather(
+            asyncio.to_thread(read_histories, "chathistory+/conversations"),
+            asyncio.to_thread(read_history, "chathistory+/chathistory.txt"),
+        )
+        conversation_store.load(histories, shared_history or LLMConfig.default_chat_history)
 
+    try:
+        await asyncio.gather(
+            startup.run("profanity list", asyncio.to_thread(pf.load_censor_words)),
+            startup.run("chat history", load_history()),
+            startup.run("tokenizer", asyncio.to_thread(get_tokenizer, llm_pool.model_path)),
+            startup.run("model", llm_pool.start()),
+        )
+        await startup.run("warm-up generation", llm_pool.warm_up(warm_up_prompt()))
+    except Exception as e:
+        startup.error = str(e)
+        print(f"The chat could not be started: {str(e)}")
     else:
-        # Writes to the History with the Appropiate amount of lines and to the complete chathistory file
-        with open("chathistory+/complete_chathistory.txt", "a", encoding="utf-8") as complete_chathistory:
-            complete_chathistory.write(f"{user_name}: {oneline_user_prompt}\n{LLMConfig.ai_name}: {oneline_response}\n")
-        
-        with open("chathistory+/complete_chathistory.txt", "r", encoding="utf-8") as complete_file:
-            lines = complete_file.readlines()
-            if len(lines) <= LLMConfig.chat_memory_length:
-                with open("chathistory+/chathistory.txt", "w", encoding="utf-8") as history_file:
-                    history_file.write("".join(lines))
-            else:
-                with open("chathistory+/chathistory.txt", "w", encoding="utf-8") as history_file:
-                    history_file.write("".join(lines[-LLMConfig.chat_memory_length:]))
+        startup.ready = True
+    #The report is printed once the bot is connected as well
+    if startup.finished():
+        print(startup.format())
+
+#Loads the LLM with the new config and swaps it in once it is ready
+async def reload_model() -> None:
+    """
+    Starts and warms up a new LLM pool in the background. The old pool keeps answering until the new one is ready,
+    then it finishes the generations it already got and stops.
+    """
+    global llm_pool
+
+    #The first model has to finish loading before it can be replaced
+    await asyncio.gather(bot.d.warm_up_task, return_exceptions=True)
+
+    new_pool = create_llm_pool()
+    started_at = time.monotonic()
+    try:
+        await new_pool.start()
+        await new_pool.warm_up(warm_up_prompt())
+        await asyncio.to_thread(get_tokenizer, new_pool.model_path)
+    except asyncio.CancelledError:
+        #A newer config is loaded instead
+        new_pool.stop()
+        raise
+    except Exception as e:
+        new_pool.stop()
+        print(f"The new model could not be loaded, the old one keeps running: {str(e)}")
+        log_event("model_reload_failed", error=str(e))
+        return
+
+    old_pool, llm_pool = llm_pool, new_pool
+    chat_scheduler.set_concurrency(len(new_pool.workers))
+    old_pool.stop()
+    startup.ready = True
+    startup.error = None
+    print(f"The new model is ready after {time.monotonic() - started_at:.2f}s.")
+
+#Applies a changed config.yml to the running bot
+async def apply_config_changes(changed: set[str]) -> None:
+    """
+    Most settings are read whenever they are used. This updates the parts that copied a setting when they were created.
+    """
+    if changed & {"Prompt", "AI Name", "Server Name", "Chat Memory Length"}:
+        llm_pool.set_prefix(f"{LLMConfig.prompt}\n\n")
+    if "Chat Memory Length" in changed:
+        conversation_store.set_max_lines(LLMConfig.chat_memory_length)
+
+    chat_scheduler.max_pending = LLMConfig.max_queued_chats
+    chat_scheduler.max_per_user = LLMConfig.max_queued_chats_per_user
+    chat_scheduler.max_per_channel = LLMConfig.max_queued_chats_per_channel
+    response_cache.max_entries = LLMConfig.response_cache_size
+    response_cache.ttl = LLMConfig.response_cache_ttl
+
+    sd_client.url = BotConfig.url.rstrip("/")
+    sd_client.timeout = SDConfig.timeout
+    sd_client.retries = SDConfig.retries
+    image_queue.batch_window = SDConfig.batch_window
+    image_queue.max_batch_size = SDConfig.max_batch_size
+    if "Max Concurrent Image Jobs" in changed:
+        image_queue.set_max_concurrent(SDConfig.max_concurrent_jobs)
+    image_cache.max_bytes = SDConfig.cache_size * 1024 ** 2
+
+    if changed & MODEL_CONFIG_KEYS:
+        #Only one new model is loaded at a time, the newest config wins
+        if bot.d.model_reload_task is not None:
+            bot.d.model_reload_task.cancel()
+        bot.d.model_reload_task = asyncio.create_task(reload_model())
+
+    if changed & RESTART_CONFIG_KEYS:
+        print(f"These settings take effect after a restart: {', '.join(sorted(changed & RESTART_CONFIG_KEYS))}")
+
+# Applies changes to the config.yml while the bot runs
+config_watcher = ConfigWatcher(config_path, apply_config_changes)
+
+#Starts the background tasks. The bot connects to Discord without waiting for the LLM.
+@bot.listen(hikari.StartingEvent)
+async def on_starting(event: hikari.StartingEvent):
+    startup.begin("Discord connection")
+    bot.d.warm_up_task = asyncio.create_task(warm_up())
+    bot.d.history_task = asyncio.create_task(history_writer.run())
+    bot.d.image_queue_task = asyncio.create_task(image_queue.run())
+    bot.d.image_archiver_task = asyncio.create_task(image_archiver.run())
+    bot.d.config_task = asyncio.create_task(config_watcher.run())
+    bot.d.model_reload_task = None
+    bot.d.metrics_server = None
+    if BotConfig.metrics_port:
+        #Only reachable from the machine the bot runs on
+        bot.d.metrics_server = await metrics.serve("127.0.0.1", BotConfig.metrics_port)
+
+#Stops the LLM workers
+@bot.listen(hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent):
+    bot.d.config_task.cancel()
+    if bot.d.model_reload_task is not None:
+        bot.d.model_reload_task.cancel()
+    llm_pool.stop()
+    if bot.d.metrics_server is not None:
+        await bot.d.metrics_server.cleanup()
+    await history_writer.flush()
+    await image_archiver.flush()
+    await sd_client.close()
 
 #Startup logic
-#Does nothing important at the moment
 @bot.listen(hikari.StartedEvent)
 async def on_startup(event: hikari.StartedEvent):
+    startup.end("Discord connection")
     print("Bot is online!")
+    #The report is printed once the model is loaded as well
+    if bot.d.warm_up_task.done():
+        print(startup.format())
 
 #/help Command
 @bot.command
@@ -102,23 +365,146 @@ async def help_command(ctx: lightbulb.SlashContext) -> None:
     else:
         await ctx.respond(BotConfig.help_message)
 
+async def show_chat_error(event: hikari.GuildMessageCreateEvent, response_message: hikari.Message, trace_id: str, error: str) -> None:
+    """
+    Replaces the answer with the error text, for requests whose answer could not be generated.
+    """
+    CHAT_REQUESTS.inc(result="error")
+    log_event("chat_failed", trace_id, error=error)
+    if BotConfig.dev_mode:
+        await event.app.rest.edit_message(response_message.channel_id, response_message.id, content="There was an error while generating the message....\n(I am in Dev Mode. Some functions may not work.)")
+    else:
+        await event.app.rest.edit_message(response_message.channel_id, response_message.id, content="There was an error while generating the message....")
+
+async def generate_answer(event: hikari.GuildMessageCreateEvent, response_message: hikari.Message, renderer: StreamRenderer, prompt: str, params: dict, cache_key: str | None, cache_pool: LLMWorkerPool, trace_id: str, received_at: float) -> bool:
+    """
+    Waits for a free slot in the chat queue and streams the answer of the LLM into the renderer.
+    With a cache key, identical prompts can listen to the generation and the answer gets cached.
+
+    Args:
+        cache_pool (LLMWorkerPool): The pool the cache key was built for. If a new model replaced it while
+            the request waited, the answer is not cached.
+        trace_id (str): The ID of the chat request in the logs.
+        received_at (float): The time.monotonic() the mention arrived at.
+
+    Returns:
+        False if the answer was not generated because the queue was full, the generation failed or the message was deleted.
+    """
+    #Waiting for a free slot in the chat queue
+    try:
+        ticket = chat_scheduler.submit(event.author.id, event.channel_id, event.message_id)
+    except ChatQueueFullError as e:
+        CHAT_REQUESTS.inc(result="rejected")
+        log_event("chat_rejected", trace_id, reason=str(e))
+        if BotConfig.dev_mode:
+            await event.app.rest.edit_message(response_message.channel_id, response_message.id, content=f"I am too busy right now. {e} Please try again later.\n(I am in Dev Mode. Some functions may not work.)")
+        else:
+            await event.app.rest.edit_message(response_message.channel_id, response_message.id, content=f"I am too busy right now. {e} Please try again later.")
+        return False
+
+    position = chat_scheduler.position(ticket)
+    log_event("chat_queued", trace_id, position=position)
+    if position > 0:
+        #The ticket must not keep its slot if the message can not be edited
+        try:
+            if BotConfig.dev_mode:
+                await event.app.rest.edit_message(response_message.channel_id, response_message.id, content=f"You are #{position} in line. Please wait...\n(I am in Dev Mode. Some functions may not work.)")
+            else:
+                await event.app.rest.edit_message(response_message.channel_id, response_message.id, content=f"You are #{position} in line. Please wait...")
+        except BaseException:
+            chat_scheduler.abandon(ticket)
+            raise
+
+    shared_generation = response_cache.start(cache_key) if cache_key is not None else None
+    response = ""
+    completed = False
+    cacheable = False
+    generation_stats = {}
+    try:
+        async with chat_scheduler.slot(ticket):
+            log_event("chat_started", trace_id, queue_wait=time.monotonic() - received_at)
+
+            #Defining the task for the AI. The generation runs on the least loaded LLM worker.
+            #Closing the stream stops the generation, also when sending the answer to Discord fails.
+            cacheable = llm_pool is cache_pool
+            async with contextlib.aclosing(llm_pool.stream(prompt, stats=generation_stats, **params)) as stream:
+                async for completionFragment in stream:
+                    #Stopping the generation if the message was deleted and nobody else waits for the answer
+                    if ticket.cancelled and (shared_generation is None or shared_generation.subscribers == 0):
+                        break
+
+                    if response == "":
+                        CHAT_TIME_TO_FIRST_TOKEN.observe(time.monotonic() - received_at)
+                    response += completionFragment
+                    if shared_generation is not None:
+                        shared_generation.push(completionFragment)
+                    if not ticket.cancelled:
+                        await renderer.feed(completionFragment)
+                else:
+                    completed = True
+    except ChatRequestCancelled:
+        pass
+    except RuntimeError as e:
+        #The LLM worker failed
+        print(f"The following error occurred while generating the answer: {str(e)}")
+        await show_chat_error(event, response_message, trace_id, str(e))
+        return False
+    finally:
+        if shared_generation is not None:
+            error = None if completed else "The answer this request was waiting for was not generated."
+            response_cache.finish(cache_key, shared_generation, response if completed and cacheable else None, error)
+
+    if generation_stats:
+        CHAT_PROMPT_EVAL.observe(generation_stats["prompt_eval"])
+        CHAT_GENERATION.observe(generation_stats["generation"])
+        CHAT_TOKENS.inc(generation_stats["tokens"])
+        if generation_stats["generation"] > 0:
+            CHAT_TOKENS_PER_SECOND.observe(generation_stats["tokens"] / generation_stats["generation"])
+        log_event("chat_generated", trace_id, **generation_stats)
+
+    if ticket.cancelled:
+        #The message was deleted, so the answer is not needed anymore
+        CHAT_REQUESTS.inc(result="cancelled")
+        log_event("chat_cancelled", trace_id)
+        await event.app.rest.delete_message(response_message.channel_id, response_message.id)
+        return False
+
+    return True
+
 @bot.listen(hikari.GuildMessageCreateEvent)
 async def chat(event: hikari.GuildMessageCreateEvent) -> None:
     """
     The Chatbot function of the Bot.
     """
-    response = ""
-
     if not event.is_human:
         return
     
     me = bot.get_me()
 
     if me.id in event.message.user_mentions_ids:
+        received_at = time.monotonic()
+        trace_id = new_trace_id()
+        log_event("chat_received", trace_id, user_id=event.author.id, channel_id=event.channel_id, message_id=event.message_id)
+
+        #The LLM is still loading in the background
+        if not startup.ready:
+            if startup.error is not None:
+                status = "My chat is not working right now. Please message Darkyl."
+            else:
+                status = "I am still warming up. Please try again in a moment."
+            if BotConfig.dev_mode:
+                await event.message.respond(f"{status}\n(I am in Dev Mode. Some functions may not work.)")
+            else:
+                await event.message.respond(status)
+            CHAT_REQUESTS.inc(result="not_ready")
+            log_event("chat_not_ready", trace_id)
+            return
+
         user_prompt = event.message.content.replace("<@820739005103472691> ", "").replace("<@820739005103472691>", "") #Getting the question and removing the mention
-        filtered_user_prompt = pf.censor(event.message.content.replace("<@820739005103472691> ", "").replace("<@820739005103472691>", ""))
+        filtered_user_prompt = pf.censor(user_prompt)
 
         user_name = event.author.username
+        conversation_key = ConversationStore.guild_key(event.channel_id)
 
         if BotConfig.dev_mode:
             response_message = await event.message.respond("Generating answer...\n(I am in Dev Mode. Some functions may not work.)")
@@ -130,40 +516,107 @@ async def chat(event: hikari.GuildMessageCreateEvent) -> None:
                 await event.app.rest.edit_message(response_message.channel_id, response_message.id, content="Your message contains a 'bad word'. I can not respond to this.\n(I am in Dev Mode. Report this Message to Darkyl if this is an Error)")
             else:
                 await event.app.rest.edit_message(response_message.channel_id, response_message.id, content="Your message contains a 'bad word'. I can not respond to this. If you believe this is an error please message Darkyl.")
+            CHAT_REQUESTS.inc(result="filtered")
+            log_event("chat_filtered", trace_id)
             return
 
-        #Defining the task for the AI
-        stream = llm(
-            f"{LLMConfig.prompt}\n\n{LLMConfig.chat_history}{user_name}: {user_prompt}\n{LLMConfig.ai_name}: ",
-            max_tokens=100,
-            temperature=0.8,
-            stop=["\n", f"{user_name}:"],
-            stream=True,
-        )
-        
-        for output in stream:
-            completionFragment = copy.deepcopy(output)
-            response += completionFragment["choices"][0]["text"]
+        #Building the prompt. The history is taken before waiting in the queue.
+        prompt = build_prompt(conversation_key, user_name, user_prompt)
+        params = {"max_tokens": MAX_ANSWER_TOKENS, "temperature": 0.8, "stop": ["\n", f"{user_name}:"]}
 
-            filtered_response = pf.censor(response)
+        if BotConfig.dev_mode:
+            renderer = StreamRenderer(event.app.rest, response_message, suffix="\n(I am in Dev Mode. Some functions may not work)", interval=LLMConfig.stream_edit_interval, token_budget=LLMConfig.stream_edit_tokens)
+        else:
+            renderer = StreamRenderer(event.app.rest, response_message, interval=LLMConfig.stream_edit_interval, token_budget=LLMConfig.stream_edit_tokens)
+
+        #In deterministic mode the same question gets the same answer. The channel's history is ignored for the cache.
+        #The model settings come from the running pool, a changed config only applies once its new model is loaded.
+        pool = llm_pool
+        cached_response = None
+        shared_generation = None
+        cache_key = None
+        if pool.deterministic:
+            cache_key = ResponseCache.key(f"{LLMConfig.prompt}\n\n", build_question(user_name, user_prompt), params, pool.model_path, pool.seed)
+            cached_response = response_cache.get(cache_key)
+            if cached_response is None:
+                shared_generation = response_cache.join(cache_key)
+
+        if cached_response is not None:
+            result = "cached"
+            await renderer.feed(cached_response)
+        elif shared_generation is not None:
+            #An identical prompt is already being answered, listening to that generation
+            result = "coalesced"
+            try:
+                async for completionFragment in shared_generation.subscribe():
+                    await renderer.feed(completionFragment)
+            except SharedGenerationFailed as e:
+                #Nothing is saved to the history for an answer that was never completed
+                await show_chat_error(event, response_message, trace_id, str(e))
+                return
+        elif await generate_answer(event, response_message, renderer, prompt, params, cache_key, pool, trace_id, received_at):
+            result = "generated"
+        else:
+            return
 
-            if response == "":
-                if BotConfig.dev_mode:
-                    rsp = await event.app.rest.edit_message(response_message.channel_id, response_message.id, content="There was an error while generating the message....\n(I am in Dev Mode. Some functions may not work)")
-                else:
-                    rsp = await event.app.rest.edit_message(response_message.channel_id, response_message.id, content="There was an error while generating the message....")
-            else:
-                if BotConfig.dev_mode:
-                    rsp = await event.app.rest.edit_message(response_message.channel_id, response_message.id, content=f"{filtered_response}\n(I am in Dev Mode. Some functions may not work)")
-                else:
-                    rsp = await event.app.rest.edit_message(response_message.channel_id, response_message.id, content=f"{filtered_response}")
-        
-        print("Generation Finished")
+        rsp = await renderer.finish("There was an error while generating the message....")
+        filtered_response = renderer.text
+        CHAT_REQUESTS.inc(result=result)
+        log_event("chat_finished", trace_id, result=result, duration=time.monotonic() - received_at, edits=renderer.edits)
 
-        log_message(user_name=user_name, user_prompt=user_prompt, response=filtered_response, dm=False)
+        log_message(user_name=user_name, user_prompt=user_prompt, response=filtered_response, conversation_key=conversation_key, trace_id=trace_id)
 
         await rsp.add_reaction("✅")
-        
+
+#Cancels queued chat requests when the triggering message gets deleted
+@bot.listen(hikari.GuildMessageDeleteEvent)
+async def cancel_chat(event: hikari.GuildMessageDeleteEvent) -> None:
+    chat_scheduler.cancel(event.message_id)
+
+#/queue Command
+@bot.command
+@lightbulb.add_checks(lightbulb.has_roles(BotConfig.admin_role)) #Only Admin role can execute this command
+@lightbulb.command("queue", "Shows the state of the chat queue")
+@lightbulb.implements(lightbulb.SlashCommand)
+async def queue_command(ctx: lightbulb.SlashContext) -> None:
+    """
+    The /queue command.
+    Responds with the queue depth and wait times of the chat queue.
+    Helps to find the right 'Number of Threads' for the server.
+    """
+    stats = chat_scheduler.stats()
+    await ctx.respond(
+        f"Waiting: {stats['pending']} | Generating: {stats['running']}\n"
+        f"Answered: {stats['completed']} | Rejected: {stats['rejected']} | Cancelled: {stats['cancelled']}\n"
+        f"Average wait: {stats['average_wait']:.1f}s | Longest wait: {stats['max_wait']:.1f}s | Oldest waiting: {stats['oldest_wait']:.1f}s",
+        flags=hikari.MessageFlag.EPHEMERAL,
+    )
+
+#/stats Command
+@bot.command
+@lightbulb.add_checks(lightbulb.has_roles(BotConfig.admin_role)) #Only Admin role can execute this command
+@lightbulb.command("stats", "Shows how fast chats and images are answered")
+@lightbulb.implements(lightbulb.SlashCommand)
+async def stats_command(ctx: lightbulb.SlashContext) -> None:
+    """
+    The /stats command.
+    Responds with a summary of the metrics. The complete metrics are served on the 'Metrics Port'.
+    """
+    image_cache_stats = image_cache.stats()
+    await ctx.respond(
+        f"**Chat** ({CHAT_TIME_TO_FIRST_TOKEN.count()} generated)\n"
+        f"First token: p50 {CHAT_TIME_TO_FIRST_TOKEN.percentile(50):.1f}s | p95 {CHAT_TIME_TO_FIRST_TOKEN.percentile(95):.1f}s\n"
+        f"Prompt eval: {CHAT_PROMPT_EVAL.average():.1f}s | Generation: {CHAT_GENERATION.average():.1f}s | {CHAT_TOKENS_PER_SECOND.average():.1f} tokens/s\n"
+        f"Discord edits: {DISCORD_EDIT_DURATION.count()} | p95 {DISCORD_EDIT_DURATION.percentile(95):.2f}s (including rate limits)\n"
+        f"**Images**\n"
+        f"txt2img: p50 {SD_REQUEST_DURATION.percentile(50, endpoint='/sdapi/v1/txt2img'):.1f}s | p95 {SD_REQUEST_DURATION.percentile(95, endpoint='/sdapi/v1/txt2img'):.1f}s\n"
+        f"Queue wait: p50 {SD_QUEUE_WAIT.percentile(50):.1f}s | p95 {SD_QUEUE_WAIT.percentile(95):.1f}s | Sending: p95 {IMAGE_SEND_DURATION.percentile(95):.1f}s\n"
+        f"Speed: {image_queue.stats()['seconds_per_step_megapixel']:.1f}s per step and megapixel\n"
+        f"Cache: {image_cache_stats['hits']} hits | {image_cache_stats['misses']} misses | {image_cache_stats['size'] / 1024 ** 2:.1f} MB\n"
+        f"**Files**\n"
+        f"Chat history: p95 {FILE_IO_DURATION.percentile(95, operation='chat_history') * 1000:.0f}ms | Image archive: p95 {FILE_IO_DURATION.percentile(95, operation='image_archive') * 1000:.0f}ms",
+        flags=hikari.MessageFlag.EPHEMERAL,
+    )
 
 #Memory Wipe command
 @bot.command
@@ -173,10 +626,15 @@ async def chat(event: hikari.GuildMessageCreateEvent) -> None:
 async def memory_wipe(ctx: lightbulb.SlashContext) -> None:
 
     #Overwriting the chat history with the default start histroy
-    with open("chathistory+/chathistory.txt", "w", encoding="utf-8") as history_file:
-        history_file.write(LLMConfig.default_chat_history)
-    with open("chathistory+/complete_chathistory.txt", "w", encoding="utf-8") as complete_file:
-        complete_file.write(LLMConfig.default_chat_history)
+    for conversation_key in conversation_store.keys():
+        history_writer.replace(conversation_path(conversation_key), LLMConfig.default_chat_history)
+    history_writer.replace("chathistory+/chathistory.txt", LLMConfig.default_chat_history)
+    conversation_store.clear(LLMConfig.default_chat_history)
+    history_writer.replace("chathistory+/complete_chathistory.txt", LLMConfig.default_chat_history)
+    await history_writer.flush()
+
+    #Dropping the cached history from the LLM
+    llm_pool.set_prefix(f"{LLMConfig.prompt}\n\n")
     
     #Sending feedback in Discord
     await ctx.respond("Memory wiped. I can not remember any previous messages including this one.")
@@ -184,45 +642,68 @@ async def memory_wipe(ctx: lightbulb.SlashContext) -> None:
     #print("Chat Memory Wiped.")
 
 #Logic for generating the image
-async def generate_image(user_name: str, user_discriminator: str, prompt: str, private: bool, steps: int, width: int, height: int, negative_prompt) -> str:
-    payload = {"prompt": prompt, "negative_prompt": negative_prompt,"steps": steps, "width": width, "height": height}
+async def generate_image(user_name: str, user_discriminator: str, prompt: str, private: bool, payload: dict, job: ImageJob | None, cache_key: str | None, trace_id: str | None = None) -> bytes:
+    """
+    Waits for the image of the job and queues it for the image folder.
+    Images with a cache key are taken from the image cache if possible and cached after the generation.
+
+    Args:
+        trace_id (str | None): The ID of the /imagine request in the logs.
 
+    Returns:
+        The PNG image, or None if the generation failed.
+    """
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
     try:
-        #Sending Image generation request to the API
-        response = requests.post(url=f"{BotConfig.url}/sdapi/v1/txt2img", json=payload)
-        r = response.json()
-
-        #Waiting for the Image to finish and then saving it.
-        for i in r["images"]:
-            image = Image.open(io.BytesIO(base64.b64decode(i.split(",", 1)[0])))
-            png_payload = {"image": "data:image/png;base64," + i}
-            response2 = requests.post(url=f"{BotConfig.url}/sdapi/v1/png-info", json=png_payload)
-            pnginfo = PngImagePlugin.PngInfo()
-            pnginfo.add_text("parameters", response2.json().get("info"))
+        r = None
+        if cache_key is not None:
+            r = await image_cache.get(cache_key)
+
+        if r is None:
+            #Waiting for the image queue. The bot keeps working while the image is generated.
+            if job is None:
+                job = image_queue.submit(payload)
+            r = await job.result()
+            log_event("image_generated", trace_id, queue_wait=job.started_at - job.enqueued_at, duration=time.monotonic() - job.started_at)
+            if cache_key is not None:
+                await image_cache.put(cache_key, r)
+        else:
+            log_event("image_cached", trace_id)
+        infotexts = json.loads(r.get("info") or "{}").get("infotexts", [])
+
+        image = None
+        for index, i in enumerate(r["images"]):
+            #The API already returns a PNG, it only needs the generation parameters
+            image = base64.b64decode(i.split(",", 1)[-1])
+            if index < len(infotexts):
+                image = add_png_text(image, "parameters", infotexts[index])
+
+            #The prompt is user input, it must not lead outside of the image folder
             if private:
-                image_path = f"image_folder/{timestamp}__{user_name}#{user_discriminator}_with the prompt_{prompt}_[PRIVATE GENERATION].png"
+                file_name = f"{timestamp}__{file_name_part(user_name)}#{user_discriminator}_with the prompt_{file_name_part(prompt)}_[PRIVATE GENERATION].png"
             else:
-                image_path = f"image_folder/{timestamp}__{user_name}#{user_discriminator}_with the prompt_{prompt}.png"
-            image.save(image_path, pnginfo=pnginfo)
-            image.save('output.png')
+                file_name = f"{timestamp}__{file_name_part(user_name)}#{user_discriminator}_with the prompt_{file_name_part(prompt)}.png"
+            image_archiver.save(file_name, image)
 
-        return image_path
+        return image
 
     except Exception as e:
         print(f"Folgender Fehler ist beim generieren des Bildes aufgetreten: {str(e)}")
+        log_event("image_failed", trace_id, error=str(e))
         return None
 
 #Sends the image
-async def send_image(ctx: lightbulb.SlashContext) -> None:
+async def send_image(ctx: lightbulb.SlashContext, image: bytes) -> None:
     """
     Sends the generated image as a file attachment in the specified context.
     """
+    started_at = time.monotonic()
     try:
         channel = await ctx.bot.rest.fetch_channel(SDConfig.darkart_channel)
-        file = hikari.File("output.png")
+        file = hikari.Bytes(image, "output.png")
         await channel.send(file)
+        IMAGE_SEND_DURATION.observe(time.monotonic() - started_at)
     except Exception as e:
         print(f"Folgender Fehler ist beim Senden des Bildes aufgetreten: {str(e)}")
         if BotConfig.dev_mode:
@@ -231,11 +712,13 @@ async def send_image(ctx: lightbulb.SlashContext) -> None:
             await ctx.author.send("Es gab einen Fehler an meinem Ende.\nKontaktiere Darkyl#6641 sollte dies öfter geschehen.")
 
 #Sends the image in DM's
-async def send_image_private(ctx: lightbulb.SlashContext) -> None:
+async def send_image_private(ctx: lightbulb.SlashContext, image: bytes) -> None:
+    started_at = time.monotonic()
     try:
-        file = hikari.File("output.png")
+        file = hikari.Bytes(image, "output.png")
         await ctx.author.send("Hier ist dein Bild!")
         await ctx.author.send(file)
+        IMAGE_SEND_DURATION.observe(time.monotonic() - started_at)
     except Exception as e:
         print(f"Folgender Fehler ist beim Senden des Bildes aufgetreten: {str(e)}")
         if BotConfig.dev_mode:
@@ -244,14 +727,66 @@ async def send_image_private(ctx: lightbulb.SlashContext) -> None:
             await ctx.author.send("Es gab einen Fehler an meinem Ende.\nKontaktiere Darkyl#6641 sollte dies öfter geschehen.")
     await ctx.respond("Das Bild wurde erfolgreich generiert.", flags=hikari.MessageFlag.EPHEMERAL)
 
+#Makes the image cheaper when so many images are queued that it would take too long
+def fit_to_load(payload: dict) -> tuple[dict, float]:
+    """
+    Lowers the steps and then the size of an image until its predicted waiting time stays below the 'Max Image Wait'.
+    Images are only changed while other images are queued or generated, and once the speed of the API was measured.
+
+    Returns:
+        The payload to generate, the same payload if nothing has to change, and the predicted time until its generation starts.
+    """
+    wait = image_queue.wait_time(payload)
+    #Without other images the wait is only the batch window
+    backlog = wait > image_queue.batch_window
+    if SDConfig.max_image_wait == 0 or not backlog or image_queue.cost_model.observations == 0:
+        return payload, wait
+    return image_queue.cost_model.fit(payload, SDConfig.max_image_wait - wait, SDConfig.min_image_steps), wait
+
+#Formats the estimated waiting time
+def format_eta(seconds: float) -> str:
+    if seconds < 60:
+        return "weniger als eine Minute"
+    return f"ca. {round(seconds / 60)} Minuten"
+
+#/imagelimit Command
+@bot.command
+@lightbulb.add_checks(lightbulb.has_roles(BotConfig.admin_role)) #Only Admin role can execute this command
+@lightbulb.option("jobs", "Wie viele Bilder gleichzeitig generiert werden dürfen", required=True, type=int, min_value=1, max_value=16)
+@lightbulb.command("imagelimit", "Begrenzt die gleichzeitigen Bildgenerierungen")
+@lightbulb.implements(lightbulb.SlashCommand)
+async def image_limit_command(ctx: lightbulb.SlashContext) -> None:
+    """
+    The /imagelimit command.
+    Changes how many txt2img calls may run at the same time until the next restart.
+    """
+    image_queue.set_max_concurrent(ctx.options.jobs)
+    stats = image_queue.stats()
+    await ctx.respond(f"Es werden jetzt bis zu {stats['max_concurrent']} Bildaufträge gleichzeitig generiert.\nWartend: {stats['pending']} | In Arbeit: {stats['running']}", flags=hikari.MessageFlag.EPHEMERAL)
+
+#/purgecache Command
+@bot.command
+@lightbulb.add_checks(lightbulb.has_roles(BotConfig.admin_role)) #Only Admin role can execute this command
+@lightbulb.command("purgecache", "Leert den Bild-Cache")
+@lightbulb.implements(lightbulb.SlashCommand)
+async def purge_cache_command(ctx: lightbulb.SlashContext) -> None:
+    """
+    The /purgecache command.
+    Removes every cached image. The hit and miss counters are shown by /stats.
+    """
+    size = image_cache.stats()["size"]
+    removed = await image_cache.purge()
+    await ctx.respond(f"{removed} Bilder ({size / 1024 ** 2:.1f} MB) wurden aus dem Cache gelöscht.", flags=hikari.MessageFlag.EPHEMERAL)
+
 #/imagine Command
 @bot.command
 @lightbulb.option("prompt", "Was soll ich malen?", required=True, type=str | None, max_length=SDConfig.max_prompt_length)
-@lightbulb.option("steps", "Qualität des Bildes", required=False, default=SDConfig.default_steps, type=int, min_value=2, max_value=30)
-@lightbulb.option("width", "Breite des Bildes (Pixel)", required=False, default=SDConfig.default_width, type=int, min_value=200, max_value=1300)
-@lightbulb.option("height", "Höhe des Bildes (Pixel)", required=False, default=SDConfig.default_heigth, type=int, min_value=200, max_value=1300)
+@lightbulb.option("steps", "Qualität des Bildes", required=False, default=None, type=int, min_value=2, max_value=30)
+@lightbulb.option("width", "Breite des Bildes (Pixel)", required=False, default=None, type=int, min_value=200, max_value=1300)
+@lightbulb.option("height", "Höhe des Bildes (Pixel)", required=False, default=None, type=int, min_value=200, max_value=1300)
 @lightbulb.option("private", "Private Bilder werden in den DMs geschickt", required=False, default=False, type=bool)
 @lightbulb.option("negative_prompt", "Was soll nicht ins Bild?", required=False, type=str)
+@lightbulb.option("seed", "Gleicher Seed und gleiche Eingabe ergeben das gleiche Bild (-1 = zufällig)", required=False, default=-1, type=int, min_value=-1, max_value=4294967295)
 @lightbulb.command("imagine", "Generiere Bilder")
 @lightbulb.implements(lightbulb.SlashCommand)
 async def imagine_command(ctx: lightbulb.SlashContext) -> None:
@@ -270,38 +805,66 @@ async def imagine_command(ctx: lightbulb.SlashContext) -> None:
     negative_prompt = f"{SDConfig.default_negative_prompt}, {ctx.options.negative_prompt}"
     user_name = ctx.author.username.replace(" ", "_")
     user_discriminator = ctx.author.discriminator
-    steps = ctx.options.steps
-    width = ctx.options.width
-    height = ctx.options.height
+    #The defaults are read here, so changes to the config.yml apply without a restart
+    steps = ctx.options.steps if ctx.options.steps is not None else SDConfig.default_steps
+    width = ctx.options.width if ctx.options.width is not None else SDConfig.default_width
+    height = ctx.options.height if ctx.options.height is not None else SDConfig.default_heigth
+    seed = ctx.options.seed
+    payload = {"prompt": prompt, "negative_prompt": negative_prompt, "steps": steps, "width": width, "height": height, "seed": seed}
+    trace_id = new_trace_id()
+    log_event("image_requested", trace_id, user_id=ctx.author.id, steps=steps, width=width, height=height, seed=seed, private=is_private)
+
+    #Images with a fixed seed are reproducible and can be taken from the cache
+    cache_key = None
+    model_name = None
+    if seed != -1 and image_cache.enabled:
+        try:
+            model_name = await sd_client.model_name()
+            cache_key = ImageCache.key(payload, model_name)
+        except SDAPIError as e:
+            print(f"Der Bild-Cache konnte nicht verwendet werden: {str(e)}")
+
+    #Queueing the image
+    if cache_key is not None and image_cache.contains(cache_key):
+        job = None
+        queue_info = "Dieses Bild wurde schon einmal generiert und kommt sofort."
+    else:
+        queue_info = ""
+        fitted_payload, wait = fit_to_load(payload)
+        if fitted_payload != payload:
+            payload = fitted_payload
+            log_event("image_reduced", trace_id, wait=wait, steps=payload["steps"], width=payload["width"], height=payload["height"])
+            queue_info = f"Vor deinem Bild sind noch andere Bilder in der Warteschlange ({format_eta(wait)}). Damit du insgesamt nicht länger als {format_eta(SDConfig.max_image_wait)} wartest, wird dein Bild mit {payload['steps']} Schritten und {payload['width']}x{payload['height']} Pixeln generiert.\n"
+            if cache_key is not None:
+                cache_key = ImageCache.key(payload, model_name)
+
+        job = image_queue.submit(payload)
+        queue_info += f"Position in der Warteschlange: {image_queue.position(job)}\nGeschätzte Wartezeit: {format_eta(image_queue.eta(job))}"
 
     #Giving response
     if is_private:
         if BotConfig.dev_mode:
-            await ctx.respond("Generiere ein Bild.\nDas Resultat wird in die DM's geschickt.\nBitte warten...\n(Ich bin im Programmier Modus. Einige Funktionen könnten nicht funktionieren.)", flags=hikari.MessageFlag.EPHEMERAL)
+            await ctx.respond(f"Generiere ein Bild.\nDas Resultat wird in die DM's geschickt.\n{queue_info}\nBitte warten...\n(Ich bin im Programmier Modus. Einige Funktionen könnten nicht funktionieren.)", flags=hikari.MessageFlag.EPHEMERAL)
         else:
-            await ctx.respond("Generiere ein Bild.\nDas Resultat wird in die DM's geschickt.\nBitte warten...", flags=hikari.MessageFlag.EPHEMERAL)
+            await ctx.respond(f"Generiere ein Bild.\nDas Resultat wird in die DM's geschickt.\n{queue_info}\nBitte warten...", flags=hikari.MessageFlag.EPHEMERAL)
     else:
         if BotConfig.dev_mode:
-            await ctx.respond(f"Generiere ein Bild mit der Eingabe: \n{prompt}.\nBitte warten...\n(Ich bin im Programmier Modus. Einige Funktionen könnten nicht funktionieren.)")
+            await ctx.respond(f"Generiere ein Bild mit der Eingabe: \n{prompt}.\n{queue_info}\nBitte warten...\n(Ich bin im Programmier Modus. Einige Funktionen könnten nicht funktionieren.)")
         else:
-            await ctx.respond(f"Generiere ein Bild mit der Eingabe: \n{prompt}.\nBitte warten...")
+            await ctx.respond(f"Generiere ein Bild mit der Eingabe: \n{prompt}.\n{queue_info}\nBitte warten...")
     
     #Calling image generating function
-    image_path = await asyncio.create_task(generate_image(user_name, user_discriminator, prompt, is_private, steps, width, height, negative_prompt))
+    image = await generate_image(user_name, user_discriminator, prompt, is_private, payload, job, cache_key, trace_id)
     
     #Sending the image to the user
     if is_private:
-        if image_path is not None:
-            await send_image_private(ctx)
+        if image is not None:
+            await send_image_private(ctx, image)
     else:
-        if image_path is not None:
-            await send_image(ctx)
+        if image is not None:
+            await send_image(ctx, image)
 
 if __name__ == "__main__":
-    validate_config()
-
-    pf.load_censor_words()
-
     if BotConfig.dev_mode:
         bot.run(
             status=hikari.Status.ONLINE,
@@ -0,0 +1,234 @@
+from collections import deque
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+
+class ChatQueueFullError(Exception):
+    """
+    Raised when a chat request can not be queued.
+    The message explains which limit was hit.
+    """
+    pass
+
+class ChatRequestCancelled(Exception):
+    """
+    Raised when a queued chat request was cancelled before it was processed.
+    """
+    pass
+
+class ChatTicket:
+    """
+    A chat request waiting for (or holding) an LLM slot.
+    """
+
+    def __init__(self, user_id: int, channel_id: int, message_id: int, rank: tuple):
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.rank = rank
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.cancelled = False
+        self._turn = asyncio.Event()
+
+    def __lt__(self, other: "ChatTicket") -> bool:
+        return self.rank < other.rank
+
+class ChatScheduler:
+    """
+    A bounded priority queue in front of the LLM.
+
+    Requests are ordered by priority first and then round robin between users,
+    so a user with several pending mentions can not starve everyone else.
+    Per user and per channel quotas limit how much work a single source can queue.
+    """
+
+    def __init__(self, max_pending: int, max_per_user: int, max_per_channel: int, concurrency: int = 1):
+        """
+        Args:
+            max_pending (int): The maximum amount of requests waiting in the queue.
+            max_per_user (int): The maximum amount of outstanding requests per user.
+            max_per_channel (int): The maximum amount of outstanding requests per channel.
+            concurrency (int): The amount of requests that are processed at the same time.
+        """
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.max_per_channel = max_per_channel
+        self.concurrency = concurrency
+
+        self._pending = []
+        self._running = 0
+        self._tickets = {}
+        self._per_user = {}
+        self._per_channel = {}
+        self._sequence = itertools.count()
+        self._wait_times = deque(maxlen=100)
+
+        self.submitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.completed = 0
+
+    def submit(self, user_id: int, channel_id: int, message_id: int, priority: int = 0) -> ChatTicket:
+        """
+        Queues a chat request.
+
+        Args:
+            user_id (int): The ID of the user that sent the message.
+            channel_id (int): The ID of the channel the message was sent in.
+            message_id (int): The ID of the triggering message. Used for cancellation.
+            priority (int): Lower values are processed first.
+
+        Returns:
+            The ticket of the request.
+
+        Raises:
+            ChatQueueFullError: If the queue or one of the quotas is full.
+        """
+        if len(self._tickets) - self._running >= self.max_pending:
+            self.rejected += 1
+            raise ChatQueueFullError("The queue is full.")
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            self.rejected += 1
+            raise ChatQueueFullError("You already have too many messages waiting for an answer.")
+        if self._per_channel.get(channel_id, 0) >= self.max_per_channel:
+            self.rejected += 1
+            raise ChatQueueFullError("There are already too many messages waiting for an answer in this channel.")
+
+        # The amount of outstanding requests of this user decides its round,
+        # so every user gets one answer before anyone gets a second one.
+        user_round = self._per_user.get(user_id, 0)
+        ticket = ChatTicket(user_id, channel_id, message_id, (priority, user_round, next(self._sequence)))
+
+        self._tickets[message_id] = ticket
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self._per_channel[channel_id] = self._per_channel.get(channel_id, 0) + 1
+        heapq.heappush(self._pending, ticket)
+        self.submitted += 1
+
+        self._dispatch()
+        return ticket
+
+    def position(self, ticket: ChatTicket) -> int:
+        """
+        Returns the position of the ticket in the queue.
+        0 means the request is already being processed.
+        """
+        if ticket.started_at is not None:
+            return 0
+        return 1 + sum(1 for other in self._pending if not other.cancelled and other.rank < ticket.rank)
+
+    def cancel(self, message_id: int) -> bool:
+        """
+        Cancels the request of a message, for example because the message was deleted.
+        Running requests are only flagged, the caller has to stop the generation.
+
+        Returns:
+            True if a request was cancelled.
+        """
+        ticket = self._tickets.get(message_id)
+        if ticket is None or ticket.cancelled:
+            return False
+
+        ticket.cancelled = True
+        self.cancelled += 1
+        if ticket.started_at is None:
+            self._release(ticket)
+            ticket._turn.set()
+        return True
+
+    def abandon(self, ticket: ChatTicket) -> None:
+        """
+        Gives up a ticket whose slot will never be entered, for example because the caller failed before 'slot'.
+        Frees its quotas, and its LLM slot if it was already dispatched.
+        """
+        if self._tickets.get(ticket.message_id) is not ticket:
+            return
+
+        if ticket.started_at is not None:
+            self._running -= 1
+        else:
+            ticket.cancelled = True
+        self._release(ticket)
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, ticket: ChatTicket):
+        """
+        Waits until it is the ticket's turn and holds an LLM slot while the block runs.
+
+        Raises:
+            ChatRequestCancelled: If the request was cancelled while waiting.
+        """
+        try:
+            await ticket._turn.wait()
+        except asyncio.CancelledError:
+            self.cancel(ticket.message_id)
+            raise
+
+        if ticket.started_at is None:
+            raise ChatRequestCancelled()
+
+        try:
+            yield ticket
+        finally:
+            self._running -= 1
+            self._release(ticket)
+            if not ticket.cancelled:
+                self.completed += 1
+            self._dispatch()
+
+    def set_concurrency(self, concurrency: int) -> None:
+        """
+        Changes how many requests may generate at the same time.
+        """
+        self.concurrency = concurrency
+        self._dispatch()
+
+    def stats(self) -> dict:
+        """
+        Returns the current queue statistics.
+        """
+        now = time.monotonic()
+        waiting = [now - ticket.enqueued_at for ticket in self._pending if not ticket.cancelled]
+        return {
+            "pending": len(waiting),
+            "running": self._running,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+            "completed": self.completed,
+            "oldest_wait": max(waiting, default=0.0),
+            "average_wait": sum(self._wait_times) / len(self._wait_times) if self._wait_times else 0.0,
+            "max_wait": max(self._wait_times, default=0.0),
+        }
+
+    def _dispatch(self) -> None:
+        """
+        Hands free slots to the next tickets in the queue.
+        """
+        while self._running < self.concurrency and self._pending:
+            ticket = heapq.heappop(self._pending)
+            if ticket.cancelled:
+                continue
+
+            ticket.started_at = time.monotonic()
+            self._wait_times.append(ticket.started_at - ticket.enqueued_at)
+            self._running += 1
+            ticket._turn.set()
+
+    def _release(self, ticket: ChatTicket) -> None:
+        """
+        Removes the ticket from the quotas.
+        """
+        if self._tickets.pop(ticket.message_id, None) is None:
+            return
+        self._per_user[ticket.user_id] -= 1
+        if self._per_user[ticket.user_id] == 0:
+            del self._per_user[ticket.user_id]
+        self._per_channel[ticket.channel_id] -= 1
+        if self._per_channel[ticket.channel_id] == 0:
+            del self._per_channel[ticket.channel_id]
@@ -8,13 +8,22 @@ timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 CONFIG_FILENAME = "config.yml"
 config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), CONFIG_FILENAME)
 
-try:
-    with open(config_path) as f:
-        config = yaml.safe_load(f)
-except FileNotFoundError:
-    raise Exception("Configuration file not found. Please make sure the config.yml file is in the Main Folder.")
-except yaml.YAMLError:
-    raise Exception("Error parsing the configuration file. Invalid YAML format. Please make sure the config.yml is formatted correctly.")
+def read_config_file(path: str = config_path) -> dict:
+    """
+    Reads the config.yml.
+
+    Returns:
+        The values of the config file.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return yaml.safe_load(f)
+    except FileNotFoundError:
+        raise Exception("Configuration file not found. Please make sure the config.yml file is in the Main Folder.")
+    except yaml.YAMLError:
+        raise Exception("Error parsing the configuration file. Invalid YAML format. Please make sure the config.yml is formatted correctly.")
+
+config = read_config_file()
 
 class InvalidConfigError(Exception):
     # Error Handling for Invalid Config Errors can be implemented here.
@@ -24,12 +33,23 @@ class SDConfig:
     """
     This class contains all the variables for the Stabel Diffusion Model.
     """
-    max_prompt_length = config["Max Prompt Length"]
-    default_width = config["Default Width"]
-    default_heigth = config["Default Height"]
-    default_negative_prompt = config["Default Negative Prompt"]
-    default_steps = config["Default Steps"]
-    darkart_channel = config["Darkart Channel"]
+
+    @classmethod
+    def load(cls, config: dict) -> None:
+        cls.max_prompt_length = config["Max Prompt Length"]
+        cls.default_width = config["Default Width"]
+        cls.default_heigth = config["Default Height"]
+        cls.default_negative_prompt = config["Default Negative Prompt"]
+        cls.default_steps = config["Default Steps"]
+        cls.darkart_channel = config["Darkart Channel"]
+        cls.timeout = config["SD Timeout"]
+        cls.retries = config["SD Retries"]
+        cls.max_concurrent_jobs = config["Max Concurrent Image Jobs"]
+        cls.batch_window = config["Image Batch Window"]
+        cls.max_batch_size = config["Max Image Batch Size"]
+        cls.cache_size = config["Image Cache Size"]
+        cls.max_image_wait = config["Max Image Wait"]
+        cls.min_image_steps = config["Min Image Steps"]
 
 class LLMConfig:
 
@@ -37,44 +57,83 @@ class LLMConfig:
     This class contains all the variables for the Large Language Model.
     """
 
-    with open("chathistory+/chathistory.txt", "r", encoding="utf-8") as chat_history_file:
-        chat_history = chat_history_file.read()
-    with open("chathistory+\dm_chathistory.txt", "r", encoding="utf-8") as dmchat_history_file:
-        dm_chat_history = dmchat_history_file.read()
-    ai_name = config["AI Name"]
-    default_chat_history = f"""Darkyl: Hello.\n{ai_name}:Hello. What questions can I answer for you?\n"""
-    server_name = config["Server Name"]
-    chat_memory_length = config["Chat Memory Length"]
-    model_path = config["Model Path"]
-    deterministic = config["Deterministic"]
-    model_seed = config["Model Seed"] if deterministic else 0  # 0 means a random seed gets chosen for each generation.
-    num_threads = config["Number of Threads"]
+    CONTEXT_SIZE = 512  # The context size of the LLM in tokens.
     MAX_TOKENS = 48  # Max tokens that the LLM will generate.
-    prompt = config["Prompt"].replace("[AI-NAME]", ai_name).replace("[SERVER-NAME]", server_name).replace("[CHAT-MEM-LEN]", f"{chat_memory_length}").replace("[TIME]", timestamp)
+
+    @classmethod
+    def load(cls, config: dict) -> None:
+        cls.ai_name = config["AI Name"]
+        cls.default_chat_history = f"""Darkyl: Hello.\n{cls.ai_name}:Hello. What questions can I answer for you?\n"""
+        cls.server_name = config["Server Name"]
+        cls.chat_memory_length = config["Chat Memory Length"]
+        cls.model_path = config["Model Path"]
+        cls.deterministic = config["Deterministic"]
+        cls.model_seed = config["Model Seed"] if cls.deterministic else 0  # 0 means a random seed gets chosen for each generation.
+        cls.num_threads = config["Number of Threads"]
+        cls.model_workers = config["Model Workers"]
+        cls.max_queued_chats = config["Max Queued Chats"]
+        cls.max_queued_chats_per_user = config["Max Queued Chats Per User"]
+        cls.max_queued_chats_per_channel = config["Max Queued Chats Per Channel"]
+        cls.stream_edit_interval = config["Stream Edit Interval"]
+        cls.stream_edit_tokens = config["Stream Edit Tokens"]
+        cls.response_cache_size = config["Response Cache Size"]
+        cls.response_cache_ttl = config["Response Cache TTL"]
+        cls.prompt = config["Prompt"].replace("[AI-NAME]", cls.ai_name).replace("[SERVER-NAME]", cls.server_name).replace("[CHAT-MEM-LEN]", f"{cls.chat_memory_length}").replace("[TIME]", timestamp)
 
 class BotConfig:
     """
     This class contains all the variables for the Bot.
     """
-    url = "http://127.0.0.1:7860"
-    token = config["Bot Token"]
-    guild = config["Guild ID"]
-    admin_role = config["Admin Role"]
-    darkart_channel = config["Darkart Channel"]
-    help_message = config["Help Message"].replace("[AI-NAME]", LLMConfig.ai_name)
-    dev_mode = config["dev mode"]
-
-def validate_config():
+
+    @classmethod
+    def load(cls, config: dict) -> None:
+        cls.url = config["SD API URL"]
+        cls.token = config["Bot Token"]
+        cls.guild = config["Guild ID"]
+        cls.admin_role = config["Admin Role"]
+        cls.darkart_channel = config["Darkart Channel"]
+        cls.help_message = config["Help Message"].replace("[AI-NAME]", LLMConfig.ai_name)
+        cls.dev_mode = config["dev mode"]
+        cls.metrics_port = config["Metrics Port"]
+
+def apply_config(values: dict) -> set[str]:
+    """
+    Makes the values the current config. Validate them with validate_config first.
+    Every class is updated at once, so no code sees a mix of old and new values.
+
+    Returns:
+        The keys whose values changed.
+    """
+    global config
+    changed = {key for key in set(config) | set(values) if config.get(key) != values.get(key)}
+    config = values
+    SDConfig.load(values)
+    LLMConfig.load(values)
+    BotConfig.load(values)
+    return changed
+
+SDConfig.load(config)
+LLMConfig.load(config)
+BotConfig.load(config)
+
+def validate_config(values: dict | None = None):
     """
     A function that checks if the provided values in the config.yml
     are valid and can be used without error.
     Raises an Error if the config data is Invalid.
+
+    Args:
+        values (dict | None): The values to check. None checks the current config.
     
     Returns:
         True if the config values are valid.
     """
+    if values is None:
+        values = config
+    if not isinstance(values, dict):
+        raise InvalidConfigError("The config.yml must contain the settings as 'Key: value' lines.")
 
-    required_keys = ["Deterministic", "Number of Threads", "Model Seed", "Guild ID", "Bot Token", "AI Name", "Prompt", "Chat Memory Length", "Server Name", "Admin Role", "Darkart Channel", "Max Prompt Length", "Default Width", "Default Height", "Default Negative Prompt", "Default Steps", "Darkart Channel", "Help Message", "dev mode", "Model Path"]
+    required_keys = ["Deterministic", "Number of Threads", "Model Seed", "Guild ID", "Bot Token", "AI Name", "Prompt", "Chat Memory Length", "Server Name", "Admin Role", "Darkart Channel", "Max Prompt Length", "Default Width", "Default Height", "Default Negative Prompt", "Default Steps", "Darkart Channel", "Help Message", "dev mode", "Model Path", "Max Queued Chats", "Max Queued Chats Per User", "Max Queued Chats Per Channel", "Stream Edit Interval", "Stream Edit Tokens", "SD API URL", "SD Timeout", "SD Retries", "Max Concurrent Image Jobs", "Image Batch Window", "Max Image Batch Size", "Image Cache Size", "Response Cache Size", "Response Cache TTL", "Model Workers", "Metrics Port", "Max Image Wait", "Min Image Steps"]
     type_validations = {
         "Deterministic": bool,
         "Number of Threads": int,
@@ -95,32 +154,82 @@ def validate_config():
         "Darkart Channel": int,
         "Help Message": str,
         "dev mode": bool,
-        "Model Path": str
+        "Model Path": str,
+        "Max Queued Chats": int,
+        "Max Queued Chats Per User": int,
+        "Max Queued Chats Per Channel": int,
+        "Stream Edit Interval": (int, float),
+        "Stream Edit Tokens": int,
+        "SD API URL": str,
+        "SD Timeout": (int, float),
+        "SD Retries": int,
+        "Max Concurrent Image Jobs": int,
+        "Image Batch Window": (int, float),
+        "Max Image Batch Size": int,
+        "Image Cache Size": int,
+        "Response Cache Size": int,
+        "Response Cache TTL": (int, float),
+        "Model Workers": int,
+        "Metrics Port": int,
+        "Max Image Wait": (int, float),
+        "Min Image Steps": int
     }
 
     for key in required_keys:
-        if key not in config:
+        if key not in values:
             raise InvalidConfigError(f"Missing key in config.yml: {key}")
 
-        if not isinstance(config[key], type_validations[key]):
-            raise InvalidConfigError(f"Invalid value for '{key}'. Must be of type {type_validations[key].__name__}")
+        if not isinstance(values[key], type_validations[key]):
+            type_names = " or ".join(t.__name__ for t in type_validations[key]) if isinstance(type_validations[key], tuple) else type_validations[key].__name__
+            raise InvalidConfigError(f"Invalid value for '{key}'. Must be of type {type_names}")
     
-    if not os.path.exists(LLMConfig.model_path):
+    if not os.path.exists(values["Model Path"]):
         raise InvalidConfigError(f"Specified Models could not be found in Models Folder.")
     
-    if config["Number of Threads"] is not None:  # Proceeding even if it's None because this is also a valid value
-        if not isinstance(config["Number of Threads"], int) or config["Number of Threads"] <= 0:
+    if values["Number of Threads"] is not None:  # Proceeding even if it's None because this is also a valid value
+        if not isinstance(values["Number of Threads"], int) or values["Number of Threads"] <= 0:
             raise InvalidConfigError("Invalid value for 'number of threads'. Must be a positive integer.")
         
-        if config["Number of Threads"] > multiprocessing.cpu_count():
+        if values["Number of Threads"] > multiprocessing.cpu_count():
             raise InvalidConfigError(f"Number of threads provided in the config exceeds available system threads. Please provide a value below {multiprocessing.cpu_count()} or None")
         
-    if config["Deterministic"]:
-        if not isinstance(config["Model Seed"], int) or config["Model Seed"] <= 0:
+    if values["Model Workers"] > values["Number of Threads"]:
+        raise InvalidConfigError("Invalid value for 'Model Workers'. Every worker needs at least one of the 'Number of Threads'.")
+
+    if values["Deterministic"]:
+        if not isinstance(values["Model Seed"], int) or values["Model Seed"] <= 0:
             raise InvalidConfigError("Invalid value for 'model seed'. Must be a positive integer.")
-        if not len(str(config["Model Seed"])) <= 10:
+        if not len(str(values["Model Seed"])) <= 10:
             raise InvalidConfigError("Invalid value for 'model seed'. Must be 10 digits long or shorter.")
         
+    for key in ["Max Queued Chats", "Max Queued Chats Per User", "Max Queued Chats Per Channel", "Stream Edit Tokens", "Max Concurrent Image Jobs", "Max Image Batch Size", "Response Cache Size", "Response Cache TTL", "Model Workers"]:
+        if values[key] <= 0:
+            raise InvalidConfigError(f"Invalid value for '{key}'. Must be a positive integer.")
+
+    if values["Stream Edit Interval"] < 0:
+        raise InvalidConfigError("Invalid value for 'Stream Edit Interval'. Must not be negative.")
+
+    if values["SD Timeout"] <= 0:
+        raise InvalidConfigError("Invalid value for 'SD Timeout'. Must be a positive number.")
+
+    if values["Image Batch Window"] < 0:
+        raise InvalidConfigError("Invalid value for 'Image Batch Window'. Must not be negative.")
+
+    if values["Image Cache Size"] < 0:
+        raise InvalidConfigError("Invalid value for 'Image Cache Size'. Must not be negative.")
+
+    if values["Max Image Wait"] < 0:
+        raise InvalidConfigError("Invalid value for 'Max Image Wait'. Must not be negative.")
+
+    if not 1 <= values["Min Image Steps"] <= 30:
+        raise InvalidConfigError("Invalid value for 'Min Image Steps'. Must be between 1 and 30.")
+
+    if values["SD Retries"] < 0:
+        raise InvalidConfigError("Invalid value for 'SD Retries'. Must not be negative.")
+
+    if not 0 <= values["Metrics Port"] <= 65535:
+        raise InvalidConfigError("Invalid value for 'Metrics Port'. Must be between 0 and 65535.")
+
     if LLMConfig.MAX_TOKENS < 48:
         raise ValueError(f"Invalid value for 'MAX_TOKENS'. Must be at least 48 and {LLMConfig.MAX_TOKENS} was provided")
     
@@ -0,0 +1,64 @@
+from config import apply_config
+from config import read_config_file
+from config import validate_config
+from typing import Awaitable, Callable
+
+import asyncio
+import os
+
+class ConfigWatcher:
+    """
+    Watches the config.yml and applies it when it changes.
+    A changed file is only applied if validate_config accepts it, otherwise the old config stays active.
+    """
+
+    def __init__(self, path: str, on_change: Callable[[set[str]], Awaitable[None]], interval: float = 2.0):
+        """
+        Args:
+            path (str): The path of the config.yml.
+            on_change (Callable[[set[str]], Awaitable[None]]): Called with the changed keys after a new config was applied.
+            interval (float): The amount of seconds between two checks of the file.
+        """
+        self.path = path
+        self.interval = interval
+        self._on_change = on_change
+        self._last_modified = self._modified()
+
+    async def run(self) -> None:
+        """
+        Checks the file every 'interval' seconds. Runs until it is cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            modified = self._modified()
+            if modified == self._last_modified:
+                continue
+            self._last_modified = modified
+            await self.reload()
+
+    async def reload(self) -> set[str]:
+        """
+        Reads, validates and applies the config.yml now.
+
+        Returns:
+            The changed keys. Empty if nothing changed or the file is invalid.
+        """
+        try:
+            values = await asyncio.to_thread(read_config_file, self.path)
+            await asyncio.to_thread(validate_config, values)
+        except Exception as e:
+            print(f"The changed config.yml was not applied: {str(e)}")
+            return set()
+
+        changed = apply_config(values)
+        if changed:
+            print(f"Applied the changed config.yml: {', '.join(sorted(changed))}")
+            await self._on_change(changed)
+        return changed
+
+    def _modified(self) -> tuple | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
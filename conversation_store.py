@@ -0,0 +1,200 @@
+from collections import deque
+from metrics import FILE_IO_DURATION
+from typing import Callable
+
+import asyncio
+import os
+import time
+
+class ConversationStore:
+    """
+    Keeps the recent chat history in memory, one conversation per guild channel.
+    Every line remembers its token count, so the history can be trimmed to fit the context of the model.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], max_lines: int, default_history: str = ""):
+        """
+        Args:
+            count_tokens (Callable[[str], int]): Returns the amount of model tokens in a text.
+            max_lines (int): The maximum amount of lines kept per conversation.
+            default_history (str): The history new conversations start with.
+        """
+        self._count_tokens = count_tokens
+        self.max_lines = max_lines
+        self._default_history = default_history
+        self._saved = {}  # Key -> history read from disk, turned into a conversation on first use
+        self._conversations = {}
+
+    @staticmethod
+    def guild_key(channel_id: int) -> tuple:
+        """
+        Returns the key of the conversation in a guild channel.
+        """
+        return ("guild", channel_id)
+
+    def add(self, key: tuple, lines: list[str]) -> None:
+        """
+        Appends lines to a conversation. The oldest lines are dropped once 'max_lines' is reached.
+
+        Args:
+            key (tuple): The key of the conversation.
+            lines (list[str]): The lines without the trailing newline.
+        """
+        conversation = self._get(key)
+        for line in lines:
+            conversation.append((f"{line}\n", self._count_tokens(line)))
+
+    def render(self, key: tuple, token_budget: int | None = None) -> str:
+        """
+        Returns the newest lines of a conversation that fit into the token budget.
+
+        Args:
+            key (tuple): The key of the conversation.
+            token_budget (int | None): The maximum amount of tokens. None returns every line.
+        """
+        lines = []
+        used_tokens = 0
+        for line, tokens in reversed(self._get(key)):
+            if token_budget is not None and used_tokens + tokens > token_budget:
+                break
+            lines.append(line)
+            used_tokens += tokens
+        return "".join(reversed(lines))
+
+    def set_max_lines(self, max_lines: int) -> None:
+        """
+        Changes how many lines are kept per conversation. Shrinking drops the oldest lines.
+        """
+        self.max_lines = max_lines
+        for key, conversation in self._conversations.items():
+            self._conversations[key] = deque(conversation, maxlen=max_lines)
+
+    def load(self, histories: dict[tuple, str], default_history: str) -> None:
+        """
+        Sets the histories the conversations continue with, for example after reading the history files.
+
+        Args:
+            histories (dict[tuple, str]): The saved history of each conversation.
+            default_history (str): The history conversations without a saved history start with.
+        """
+        self._saved = dict(histories)
+        self._default_history = default_history
+
+    def keys(self) -> set[tuple]:
+        """
+        Returns the keys of every known conversation, including the ones that were only loaded.
+        """
+        return set(self._saved) | set(self._conversations)
+
+    def clear(self, history: str = "") -> None:
+        """
+        Forgets every conversation. New conversations start with the given history.
+        """
+        self._default_history = history
+        self._saved.clear()
+        self._conversations.clear()
+
+    def _get(self, key: tuple) -> deque:
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            conversation = deque(maxlen=self.max_lines)
+            for line in self._saved.pop(key, self._default_history).splitlines():
+                conversation.append((f"{line}\n", self._count_tokens(line)))
+            self._conversations[key] = conversation
+        return conversation
+
+class HistoryWriter:
+    """
+    Writes the chat history files in the background.
+    Appends are collected and written together, a file is never read back.
+    """
+
+    def __init__(self, interval: float = 5.0):
+        """
+        Args:
+            interval (float): The amount of seconds between two writes.
+        """
+        self.interval = interval
+        self._pending = {}
+        self._lock = asyncio.Lock()  # Only one flush writes at a time, so an older write can not land after a newer one
+
+    def append(self, path: str, text: str) -> None:
+        """
+        Appends text to a file with the next write.
+        """
+        if path in self._pending:
+            self._pending[path][1] += text
+        else:
+            self._pending[path] = ["a", text]
+
+    def replace(self, path: str, text: str) -> None:
+        """
+        Overwrites a file with the next write. Pending appends to the file are dropped.
+        """
+        self._pending[path] = ["w", text]
+
+    async def run(self) -> None:
+        """
+        Writes the pending changes every 'interval' seconds. Runs until it is cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Writes the pending changes now.
+        """
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            started_at = time.monotonic()
+            await asyncio.to_thread(_write_files, pending)
+            FILE_IO_DURATION.observe(time.monotonic() - started_at, operation="chat_history")
+
+def history_file_name(key: tuple) -> str:
+    """
+    Returns the name of the history file of a conversation, for example 'guild_1234.txt'.
+    """
+    return f"{key[0]}_{key[1]}.txt"
+
+def read_history(path: str) -> str:
+    """
+    Returns the content of a chat history file, or an empty history if the file does not exist yet.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as history_file:
+            return history_file.read()
+    except FileNotFoundError:
+        return ""
+
+def read_histories(folder: str) -> dict[tuple, str]:
+    """
+    Reads the history file of every conversation in the folder.
+
+    Returns:
+        The history of each conversation key. Empty if the folder does not exist yet.
+    """
+    histories = {}
+    try:
+        file_names = os.listdir(folder)
+    except FileNotFoundError:
+        return histories
+
+    for file_name in file_names:
+        kind, _, conversation_id = file_name.removesuffix(".txt").partition("_")
+        if not file_name.endswith(".txt") or not conversation_id.isdigit():
+            continue
+        with open(os.path.join(folder, file_name), "r", encoding="utf-8") as history_file:
+            histories[(kind, int(conversation_id))] = history_file.read()
+    return histories
+
+def _write_files(pending: dict) -> None:
+    for path, (mode, text) in pending.items():
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, mode, encoding="utf-8") as history_file:
+                history_file.write(text)
+        except OSError as e:
+            print(f"The chat history could not be saved to {path}: {str(e)}")
@@ -0,0 +1,94 @@
+"""
+A fake Stable Diffusion API for testing the bot without a GPU.
+Mimics the /sdapi/v1 endpoints the bot uses and returns plain colored images.
+
+Usage:
+    python fake_sd_server.py --port 7860 --seconds-per-step 0.1
+"""
+from aiohttp import web
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import struct
+import zlib
+
+def make_png(width: int, height: int, color: tuple) -> bytes:
+    """
+    Encodes a single colored RGB image as PNG.
+    """
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+    row = b"\x00" + bytes(color) * width
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(row * height)) + chunk(b"IEND", b"")
+
+class FakeSDServer:
+    """
+    The fake API. Every generation takes 'seconds_per_step' seconds per step and megapixel.
+    Only one generation runs at a time, like on the real API.
+    """
+
+    def __init__(self, seconds_per_step: float = 0.0, model: str = "fake-model.safetensors"):
+        self.seconds_per_step = seconds_per_step
+        self.model = model
+        self.requests = {"txt2img": 0, "interrupt": 0, "options": 0}
+        self._lock = asyncio.Lock()
+        self._interrupted = False
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/sdapi/v1/txt2img", self.txt2img)
+        app.router.add_post("/sdapi/v1/interrupt", self.interrupt)
+        app.router.add_get("/sdapi/v1/options", self.options)
+        return app
+
+    async def txt2img(self, request: web.Request) -> web.Response:
+        self.requests["txt2img"] += 1
+        payload = await request.json()
+        width = payload.get("width", 512)
+        height = payload.get("height", 512)
+        steps = payload.get("steps", 20)
+        batch_size = payload.get("batch_size", 1)
+        seed = payload.get("seed", -1)
+        if seed == -1:
+            seed = random.randint(0, 2 ** 32 - 1)
+
+        async with self._lock:
+            self._interrupted = False
+            duration = self.seconds_per_step * steps * width * height / 1_000_000 * batch_size
+            for _ in range(steps):
+                if self._interrupted:
+                    break
+                await asyncio.sleep(duration / steps)
+
+        images = []
+        infotexts = []
+        for index in range(batch_size):
+            color = random.Random(seed + index).randbytes(3)
+            images.append(base64.b64encode(make_png(width, height, tuple(color))).decode("ascii"))
+            infotexts.append(f"{payload.get('prompt', '')}\nNegative prompt: {payload.get('negative_prompt', '')}\nSteps: {steps}, Seed: {seed + index}, Size: {width}x{height}, Model: {self.model}")
+
+        info = {"prompt": payload.get("prompt", ""), "seed": seed, "all_seeds": [seed + index for index in range(batch_size)], "infotexts": infotexts}
+        return web.json_response({"images": images, "parameters": payload, "info": json.dumps(info)})
+
+    async def interrupt(self, request: web.Request) -> web.Response:
+        self.requests["interrupt"] += 1
+        self._interrupted = True
+        return web.json_response({})
+
+    async def options(self, request: web.Request) -> web.Response:
+        self.requests["options"] += 1
+        return web.json_response({"sd_model_checkpoint": self.model})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a fake Stable Diffusion API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--seconds-per-step", type=float, default=0.1, help="Generation time per step and megapixel")
+    args = parser.parse_args()
+
+    web.run_app(FakeSDServer(args.seconds_per_step).app(), host=args.host, port=args.port)
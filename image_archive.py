@@ -0,0 +1,118 @@
+from metrics import FILE_IO_DURATION
+
+import asyncio
+import os
+import struct
+import time
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+MAX_FILE_NAME_PART = 100  # Characters of a prompt that are kept in a file name
+
+def file_name_part(text: str, max_length: int = MAX_FILE_NAME_PART) -> str:
+    """
+    Makes user input safe to be part of a file name.
+    Path separators, '..' and control characters are replaced, and the text is shortened to 'max_length' characters.
+    """
+    text = "".join("_" if char in "/\\" or ord(char) < 32 else char for char in text)
+    return text.replace("..", "_")[:max_length]
+
+def add_png_text(png: bytes, keyword: str, text: str) -> bytes:
+    """
+    Adds a tEXt chunk to an encoded PNG without decoding or re-encoding the image.
+    The chunk is not added if the PNG already has a text chunk with this keyword.
+
+    Args:
+        png (bytes): The encoded PNG.
+        keyword (str): The keyword of the chunk, for example 'parameters'.
+        text (str): The text of the chunk.
+
+    Returns:
+        The PNG with the text chunk.
+    """
+    if not png.startswith(PNG_SIGNATURE):
+        raise ValueError("The image is not a PNG.")
+
+    # Walking the chunks to find the end of IHDR and existing text chunks
+    ihdr_end = None
+    position = len(PNG_SIGNATURE)
+    while position + 8 <= len(png):
+        length, chunk_type = struct.unpack(">I4s", png[position:position + 8])
+        data = png[position + 8:position + 8 + length]
+        if chunk_type == b"IHDR":
+            ihdr_end = position + 12 + length
+        elif chunk_type in (b"tEXt", b"iTXt", b"zTXt") and data.split(b"\x00", 1)[0] == keyword.encode("latin-1"):
+            return png
+        elif chunk_type == b"IEND":
+            break
+        position += 12 + length
+
+    if ihdr_end is None:
+        raise ValueError("The PNG has no IHDR chunk.")
+
+    # tEXt is latin-1, iTXt is needed for everything else (emojis in the prompt, ...)
+    try:
+        chunk_type = b"tEXt"
+        data = keyword.encode("latin-1") + b"\x00" + text.encode("latin-1")
+    except UnicodeEncodeError:
+        chunk_type = b"iTXt"
+        data = keyword.encode("latin-1") + b"\x00\x00\x00\x00\x00" + text.encode("utf-8")
+
+    chunk = struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+    return png[:ihdr_end] + chunk + png[ihdr_end:]
+
+class ImageArchiver:
+    """
+    Saves the generated images to the image folder in the background.
+    The images are written exactly as they were received, they are never encoded again.
+    """
+
+    def __init__(self, folder: str = "image_folder"):
+        """
+        Args:
+            folder (str): The folder the images are saved in.
+        """
+        self.folder = folder
+        self._images = asyncio.Queue()
+
+    def save(self, file_name: str, image: bytes) -> None:
+        """
+        Queues an image to be saved in the image folder. Build user input into the name with file_name_part.
+        """
+        self._images.put_nowait((file_name, image))
+
+    async def flush(self) -> None:
+        """
+        Saves every queued image now.
+        """
+        while not self._images.empty():
+            file_name, image = self._images.get_nowait()
+            await self._save(file_name, image)
+
+    async def run(self) -> None:
+        """
+        Saves the queued images. Runs until it is cancelled.
+        """
+        while True:
+            file_name, image = await self._images.get()
+            await self._save(file_name, image)
+
+    async def _save(self, file_name: str, image: bytes) -> None:
+        started_at = time.monotonic()
+        try:
+            await asyncio.to_thread(_write_image, self.folder, file_name, image)
+        except (OSError, ValueError) as e:
+            print(f"Folgender Fehler ist beim Speichern des Bildes aufgetreten: {str(e)}")
+        FILE_IO_DURATION.observe(time.monotonic() - started_at, operation="image_archive")
+
+def _write_image(folder: str, file_name: str, image: bytes) -> None:
+    """
+    Writes the image into the folder. Only the folder itself is created, names that lead outside of it are refused.
+    """
+    os.makedirs(folder, exist_ok=True)
+    folder = os.path.realpath(folder)
+    path = os.path.realpath(os.path.join(folder, file_name))
+    if os.path.dirname(path) != folder:
+        raise ValueError(f"{file_name} is not a file name inside of the image folder.")
+    with open(path, "wb") as image_file:
+        image_file.write(image)
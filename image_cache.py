@@ -0,0 +1,165 @@
+from collections import OrderedDict
+from metrics import FILE_IO_DURATION
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+class ImageCache:
+    """
+    Caches txt2img results on disk.
+
+    Only generations with a fixed seed are reproducible, so only those should be cached.
+    The key is a hash of the whole payload and the loaded model. The least recently used
+    results are removed once the cache grows above 'max_bytes'.
+    """
+
+    def __init__(self, folder: str, max_bytes: int):
+        """
+        Args:
+            folder (str): The folder the results are saved in.
+            max_bytes (int): The maximum size of the cache. 0 disables the cache.
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # Key -> size in bytes, least recently used first
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+        # The modification time is updated on every hit, so it gives the order of use
+        if os.path.isdir(folder):
+            files = [entry for entry in os.scandir(folder) if entry.name.endswith(".json")]
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+                size = entry.stat().st_size
+                self._entries[entry.name[:-len(".json")]] = size
+                self._size += size
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def size(self) -> int:
+        """
+        The size of the cache in bytes.
+        """
+        return self._size
+
+    @staticmethod
+    def key(payload: dict, model: str) -> str:
+        """
+        Returns the cache key of a txt2img payload.
+
+        Args:
+            payload (dict): The txt2img payload, including the seed.
+            model (str): The name of the loaded model.
+        """
+        return hashlib.sha256(json.dumps({"payload": payload, "model": model}, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def contains(self, key: str) -> bool:
+        return key in self._entries
+
+    async def get(self, key: str) -> dict | None:
+        """
+        Returns the cached txt2img response, or None if it is not cached.
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        started_at = time.monotonic()
+        try:
+            response = await asyncio.to_thread(_read_entry, self._path(key))
+        except (OSError, ValueError):
+            self._forget(key)
+            self.misses += 1
+            return None
+        finally:
+            FILE_IO_DURATION.observe(time.monotonic() - started_at, operation="image_cache_read")
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    async def put(self, key: str, response: dict) -> None:
+        """
+        Caches a txt2img response and removes the least recently used ones if the cache is too big.
+        """
+        if not self.enabled:
+            return
+
+        data = json.dumps(response).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+
+        self._forget(key)
+        self._entries[key] = len(data)
+        self._size += len(data)
+
+        evicted = []
+        while self._size > self.max_bytes:
+            old_key, size = self._entries.popitem(last=False)
+            self._size -= size
+            evicted.append(self._path(old_key))
+
+        started_at = time.monotonic()
+        try:
+            await asyncio.to_thread(_write_entry, self._path(key), data, evicted)
+        except OSError as e:
+            self._forget(key)
+            print(f"Das Bild konnte nicht im Cache gespeichert werden: {str(e)}")
+        FILE_IO_DURATION.observe(time.monotonic() - started_at, operation="image_cache_write")
+
+    async def purge(self) -> int:
+        """
+        Removes every cached result.
+
+        Returns:
+            The amount of removed results.
+        """
+        paths = [self._path(key) for key in self._entries]
+        self._entries.clear()
+        self._size = 0
+        await asyncio.to_thread(_remove_files, paths)
+        return len(paths)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "size": self._size,
+            "max_size": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.json")
+
+    def _forget(self, key: str) -> None:
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+def _read_entry(path: str) -> dict:
+    with open(path, "rb") as cache_file:
+        response = json.loads(cache_file.read())
+    # Marks the entry as recently used for the next start
+    os.utime(path)
+    return response
+
+def _write_entry(path: str, data: bytes, evicted: list[str]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as cache_file:
+        cache_file.write(data)
+    os.replace(f"{path}.tmp", path)
+    _remove_files(evicted)
+
+def _remove_files(paths: list[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
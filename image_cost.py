@@ -0,0 +1,73 @@
+MIN_SIZE = 256  # Images are never scaled down further than to this many pixels on the shorter side
+
+class ImageCostModel:
+    """
+    Learns how fast the Stable Diffusion API is, in seconds per step per megapixel.
+    Generation time grows about linearly with the steps, the pixels and the images in a batch,
+    so one number is enough to predict how long a txt2img call takes.
+    """
+
+    def __init__(self, seconds_per_unit: float = 15.0, smoothing: float = 0.2):
+        """
+        Args:
+            seconds_per_unit (float): The starting guess, in seconds per step per megapixel.
+                The default is about a minute for 15 steps at 512x512.
+            smoothing (float): How much a new measurement moves the learned value.
+        """
+        self.seconds_per_unit = seconds_per_unit
+        self.smoothing = smoothing
+        self.observations = 0
+
+    @staticmethod
+    def units(payload: dict, batch_size: int = 1) -> float:
+        """
+        Returns the work of a txt2img call, in steps times megapixels.
+        """
+        return payload["steps"] * payload["width"] * payload["height"] / 1_000_000 * batch_size
+
+    def estimate(self, payload: dict, batch_size: int = 1) -> float:
+        """
+        Returns the predicted amount of seconds a txt2img call takes.
+        """
+        return self.units(payload, batch_size) * self.seconds_per_unit
+
+    def observe(self, payload: dict, batch_size: int, duration: float) -> None:
+        """
+        Learns from a finished txt2img call.
+        """
+        units = self.units(payload, batch_size)
+        if units <= 0:
+            return
+        self.seconds_per_unit = (1 - self.smoothing) * self.seconds_per_unit + self.smoothing * duration / units
+        self.observations += 1
+
+    def fit(self, payload: dict, seconds: float, min_steps: int) -> dict:
+        """
+        Makes an image cheap enough to be generated in 'seconds'.
+        The steps are lowered first, down to 'min_steps'. If that is not enough, the size is lowered while keeping the aspect ratio.
+
+        Returns:
+            The payload with the new steps and size. If even the smallest image takes too long, the smallest image.
+        """
+        if self.estimate(payload) <= seconds:
+            return payload
+
+        steps = payload["steps"]
+        width = payload["width"]
+        height = payload["height"]
+        seconds_per_step = self.estimate(dict(payload, steps=1))
+        fitting_steps = int(max(seconds, 0) / seconds_per_step)
+        if fitting_steps >= min_steps:
+            return dict(payload, steps=fitting_steps)
+        steps = min(steps, min_steps)
+
+        # The pixels that fit into the time with the fewest steps
+        fitting_pixels = max(seconds, 0) / (steps * self.seconds_per_unit) * 1_000_000
+        scale = min((fitting_pixels / (width * height)) ** 0.5, 1.0)
+        # Both sides get the same scale, so the aspect ratio stays the same
+        scale = max(scale, min(MIN_SIZE / min(width, height), 1.0))
+        if scale < 1.0:
+            # Stable Diffusion needs multiples of 8
+            width = max(int(width * scale) // 8 * 8, 8)
+            height = max(int(height * scale) // 8 * 8, 8)
+        return dict(payload, steps=steps, width=width, height=height)
@@ -0,0 +1,225 @@
+from image_cost import ImageCostModel
+from metrics import SD_QUEUE_WAIT
+from typing import Awaitable, Callable
+
+import asyncio
+import json
+import time
+
+def batch_key(payload: dict) -> str:
+    """
+    Payloads with the same key can be generated together in one batch.
+    """
+    return json.dumps(payload, sort_keys=True)
+
+class ImageJob:
+    """
+    A queued /imagine request.
+    """
+
+    def __init__(self, payload: dict):
+        """
+        Args:
+            payload (dict): The txt2img payload of a single image.
+        """
+        self.payload = payload
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finishes_at = None  # The predicted end of the generation, once it started
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def batch_key(self) -> str:
+        """
+        Jobs with the same key can be generated together in one batch.
+        """
+        return batch_key(self.payload)
+
+    async def result(self) -> dict:
+        """
+        Waits for the image.
+
+        Returns:
+            A txt2img response that only contains the image of this job.
+        """
+        return await asyncio.shield(self.future)
+
+class ImageQueue:
+    """
+    Queues the /imagine requests in front of the Stable Diffusion API.
+
+    Pending jobs with the same payload are merged into one txt2img call with a bigger batch_size,
+    and the images are handed back to the right jobs. Jobs with a fixed seed would get the same image anyway,
+    so they share a single image instead. The amount of calls that run at the same time is limited,
+    so admins can cap how much GPU/CPU time image generation takes.
+    The waiting times are predicted with a cost model that learns from every finished call.
+    """
+
+    def __init__(self, generate: Callable[[dict], Awaitable[dict]], max_concurrent: int, batch_window: float, max_batch_size: int, cost_model: ImageCostModel | None = None):
+        """
+        Args:
+            generate (Callable[[dict], Awaitable[dict]]): Sends a txt2img payload to the API.
+            max_concurrent (int): The maximum amount of txt2img calls at the same time.
+            batch_window (float): Seconds a job waits for compatible jobs before it is started.
+            max_batch_size (int): The maximum amount of images in one txt2img call.
+            cost_model (ImageCostModel | None): Predicts how long a call takes. None starts a new one.
+        """
+        self._generate = generate
+        self.max_concurrent = max_concurrent
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.cost_model = cost_model if cost_model is not None else ImageCostModel()
+
+        self._pending = []
+        self._running = 0
+        self._running_until = []  # The predicted end of every running call
+        self._wakeup = asyncio.Event()
+
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+
+    def submit(self, payload: dict) -> ImageJob:
+        """
+        Queues an image.
+
+        Args:
+            payload (dict): The txt2img payload of a single image.
+
+        Returns:
+            The job. Use 'await job.result()' to get the image.
+        """
+        job = ImageJob(payload)
+        self._pending.append(job)
+        self._wakeup.set()
+        return job
+
+    def position(self, job: ImageJob) -> int:
+        """
+        Returns the position of the job in the queue. 0 means the image is being generated.
+        """
+        if job.started_at is not None:
+            return 0
+        return self._pending.index(job) + 1
+
+    def eta(self, job: ImageJob) -> float:
+        """
+        Returns the estimated amount of seconds until the image is done.
+        """
+        position = self.position(job)
+        if position == 0:
+            return max(job.finishes_at - time.monotonic(), 0.0)
+        return self._wait(self._pending[:position - 1], job.batch_key) + self.cost_model.estimate(job.payload)
+
+    def wait_time(self, payload: dict) -> float:
+        """
+        Returns the estimated amount of seconds an image would wait before its generation starts, if it was queued now.
+        """
+        return self._wait(self._pending, batch_key(payload))
+
+    def _wait(self, ahead: list[ImageJob], key: str) -> float:
+        """
+        Spreads the remaining work of the running calls and of the jobs ahead over the free slots.
+        """
+        now = time.monotonic()
+        work = sum(max(finishes_at - now, 0.0) for finishes_at in self._running_until)
+
+        # Jobs with the same payload are generated together with this one
+        calls = {}
+        for other in ahead:
+            if other.batch_key != key:
+                calls.setdefault(other.batch_key, []).append(other)
+        for jobs in calls.values():
+            work += self.cost_model.estimate(jobs[0].payload, self._batch_size(jobs[:self.max_batch_size]))
+        return work / self.max_concurrent + self.batch_window
+
+    def set_max_concurrent(self, max_concurrent: int) -> None:
+        """
+        Changes how many txt2img calls may run at the same time.
+        """
+        self.max_concurrent = max_concurrent
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        """
+        Returns the current queue statistics.
+        """
+        return {
+            "pending": len(self._pending),
+            "running": self._running,
+            "max_concurrent": self.max_concurrent,
+            "completed": self.completed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "seconds_per_step_megapixel": self.cost_model.seconds_per_unit,
+        }
+
+    async def run(self) -> None:
+        """
+        Starts the jobs whenever a slot is free. Runs until it is cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while self._running < self.max_concurrent and self._pending:
+                oldest = self._pending[0]
+
+                # Giving compatible jobs a moment to arrive
+                wait_left = self.batch_window - (time.monotonic() - oldest.enqueued_at)
+                if wait_left > 0:
+                    loop.call_later(wait_left, self._wakeup.set)
+                    break
+
+                batch = [job for job in self._pending if job.batch_key == oldest.batch_key][:self.max_batch_size]
+                finishes_at = time.monotonic() + self.cost_model.estimate(oldest.payload, self._batch_size(batch))
+                for job in batch:
+                    self._pending.remove(job)
+                    job.started_at = time.monotonic()
+                    job.finishes_at = finishes_at
+                    SD_QUEUE_WAIT.observe(job.started_at - job.enqueued_at)
+                self._running_until.append(finishes_at)
+
+                self._running += 1
+                asyncio.create_task(self._process(batch))
+
+    def _batch_size(self, batch: list[ImageJob]) -> int:
+        """
+        Returns the amount of images the txt2img call of a batch generates. Jobs with a fixed seed share one image.
+        """
+        return 1 if batch[0].payload.get("seed", -1) != -1 else len(batch)
+
+    async def _process(self, batch: list[ImageJob]) -> None:
+        """
+        Generates the images of a batch with one txt2img call and hands them to the jobs.
+        """
+        started_at = time.monotonic()
+        fixed_seed = batch[0].payload.get("seed", -1) != -1
+        batch_size = self._batch_size(batch)
+        try:
+            response = await self._generate(dict(batch[0].payload, batch_size=batch_size))
+
+            # A grid image might come first, the single images are always last
+            images = response["images"][-batch_size:]
+            info = json.loads(response.get("info") or "{}")
+            infotexts = info.get("infotexts", [])[-batch_size:]
+
+            for index, job in enumerate(batch):
+                if fixed_seed:
+                    index = 0
+                job_info = dict(info, infotexts=infotexts[index:index + 1])
+                if not job.future.done():
+                    job.future.set_result({"images": images[index:index + 1], "info": json.dumps(job_info)})
+            self.completed += len(batch)
+            self.cost_model.observe(batch[0].payload, batch_size, time.monotonic() - started_at)
+        except Exception as e:
+            for job in batch:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            self.failed += len(batch)
+        finally:
+            self.batches += 1
+            self._running -= 1
+            self._running_until.remove(batch[0].finishes_at)
+            self._wakeup.set()
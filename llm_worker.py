@@ -0,0 +1,334 @@
+from llama_cpp import Llama
+from prompt_cache import PromptCache
+
+import asyncio
+import contextlib
+import itertools
+import llama_cpp
+import multiprocessing
+import queue
+import threading
+import time
+
+class LLMWorker:
+    """
+    Owns a Llama instance and runs every generation outside of the event loop,
+    either on a dedicated thread or in a separate process.
+    Generated tokens are handed back to the event loop through an asyncio queue,
+    so a long generation never blocks the Discord gateway.
+    """
+
+    def __init__(self, prefix: str, cache_folder: str, use_process: bool = False, **llama_kwargs):
+        """
+        Args:
+            prefix (str): The static start of every prompt. Its state is cached, see PromptCache.
+            cache_folder (str): The folder the prompt cache is saved in.
+            use_process (bool): Runs the model in a separate process instead of a thread.
+            **llama_kwargs: The arguments used to construct the Llama instance.
+        """
+        self._prefix = prefix
+        self._cache_folder = cache_folder
+        self._llama_kwargs = llama_kwargs
+        self._job_ids = itertools.count()
+        self._streams = {}  # Job ID -> (event loop, asyncio queue) of the running streams
+        self._loaded = threading.Event()
+        self._load_error = None
+        self._started = False
+        self._exited = False  # Set once the worker died unexpectedly
+        self.load = 0  # The amount of queued and running generations
+
+        if use_process:
+            context = multiprocessing.get_context("spawn")
+            self._jobs, self._results, self._cancels = context.Queue(), context.Queue(), context.Queue()
+            self._runner = context.Process(target=_serve, args=self._serve_args(), name="llm-worker", daemon=True)
+        else:
+            self._jobs, self._results, self._cancels = queue.Queue(), queue.Queue(), queue.Queue()
+            self._runner = threading.Thread(target=_serve, args=self._serve_args(), name="llm-worker", daemon=True)
+
+    async def start(self) -> None:
+        """
+        Starts the worker and waits until the model is loaded.
+
+        Raises:
+            RuntimeError: If the model could not be loaded.
+        """
+        if self._started:
+            return
+        self._started = True
+
+        self._runner.start()
+        threading.Thread(target=self._pump, name="llm-worker-results", daemon=True).start()
+
+        await asyncio.to_thread(self._wait_until_loaded)
+        if self._load_error is not None:
+            raise RuntimeError(f"The LLM could not be loaded: {self._load_error}")
+
+    def stop(self) -> None:
+        """
+        Tells the worker to exit once the current generation is done.
+        """
+        self._jobs.put(None)
+
+    @property
+    def alive(self) -> bool:
+        """
+        False once the worker died, for example because the process crashed.
+        """
+        return not self._exited
+
+    def set_prefix(self, prefix: str) -> None:
+        """
+        Changes the static start of the prompts. The cached state is rebuilt by the worker.
+        Setting the same prefix again drops everything the model evaluated after the prefix.
+        """
+        self._prefix = prefix
+        self._jobs.put(("prefix", prefix))
+
+    async def stream(self, prompt: str, stats: dict | None = None, **kwargs):
+        """
+        Generates a completion for the prompt and yields the text fragments as they arrive.
+        Leaving the loop early cancels the generation after the current token.
+
+        Args:
+            prompt (str): The prompt for the LLM.
+            stats (dict | None): Gets the timings of the generation once it is done
+                ('prompt_eval' and 'generation' in seconds, 'tokens').
+            **kwargs: Additional arguments passed to the Llama call (max_tokens, stop, ...).
+
+        Raises:
+            RuntimeError: If the generation failed or the worker died.
+        """
+        job_id = next(self._job_ids)
+        fragments = asyncio.Queue()
+        self._streams[job_id] = (asyncio.get_running_loop(), fragments)
+        # Checked after registering, so a worker that dies right now either fails this stream or is noticed here
+        if self._exited:
+            self._streams.pop(job_id, None)
+            raise RuntimeError("The generation failed: The LLM worker is not running.")
+        self._jobs.put(("generate", job_id, prompt, kwargs))
+        self.load += 1
+
+        finished = False
+        try:
+            while True:
+                kind, value = await fragments.get()
+                if kind == "end":
+                    finished = True
+                    if stats is not None and value is not None:
+                        stats.update(value)
+                    return
+                if kind == "error":
+                    finished = True
+                    raise RuntimeError(f"The generation failed: {value}")
+                yield value
+        finally:
+            self.load -= 1
+            if not finished:
+                self._cancels.put(job_id)
+
+    def _wait_until_loaded(self) -> None:
+        """
+        Blocks until the model is loaded or the worker died while loading it.
+        """
+        while not self._loaded.wait(1):
+            if not self._runner.is_alive():
+                self._load_error = "The worker exited while loading the model."
+                return
+
+    def _serve_args(self) -> tuple:
+        return (self._llama_kwargs, self._prefix, self._cache_folder, self._jobs, self._results, self._cancels)
+
+    def _pump(self) -> None:
+        """
+        Hands the results of the worker over to the event loops of the streams.
+        If the worker dies, its open streams fail instead of waiting forever.
+        """
+        while True:
+            try:
+                job_id, kind, value = self._results.get(timeout=1)
+            except queue.Empty:
+                if not self._runner.is_alive():
+                    self._fail_streams("The LLM worker exited unexpectedly.")
+                    return
+                continue
+
+            if kind == "loaded":
+                self._load_error = value
+                self._loaded.set()
+                if value is not None:
+                    return
+                continue
+            if kind == "stopped":
+                return
+
+            stream = self._streams.get(job_id)
+            if stream is None:
+                continue
+            if kind in ("end", "error"):
+                del self._streams[job_id]
+
+            self._deliver(stream, kind, value)
+
+    def _fail_streams(self, error: str) -> None:
+        """
+        Marks the worker as dead and ends every open stream with an error.
+        """
+        self._exited = True
+        if self._loaded.is_set():
+            print(error)
+        for job_id in list(self._streams):
+            stream = self._streams.pop(job_id, None)
+            if stream is not None:
+                self._deliver(stream, "error", error)
+
+    def _deliver(self, stream: tuple, kind: str, value) -> None:
+        loop, fragments = stream
+        try:
+            loop.call_soon_threadsafe(fragments.put_nowait, (kind, value))
+        except RuntimeError:
+            # The event loop is already closed, nobody is listening anymore.
+            pass
+
+class LLMWorkerPool:
+    """
+    Several LLM workers, each in its own process with its own llama.cpp context.
+    The processes share the memory mapped model file and split the thread budget between them.
+    Every generation goes to the least loaded worker.
+    With a single worker, the model runs on a thread of the bot process instead.
+    """
+
+    def __init__(self, workers: int, prefix: str, cache_folder: str, n_threads: int, **llama_kwargs):
+        """
+        Args:
+            workers (int): The amount of workers.
+            prefix (str): The static start of every prompt.
+            cache_folder (str): The folder the prompt cache is saved in.
+            n_threads (int): The amount of threads all workers together may use.
+            **llama_kwargs: The arguments used to construct the Llama instances.
+        """
+        self.model_path = llama_kwargs.get("model_path")
+        self.seed = llama_kwargs.get("seed", 0)
+        threads_per_worker = max(1, n_threads // workers)
+        self.workers = [
+            LLMWorker(prefix, cache_folder, use_process=workers > 1, n_threads=threads_per_worker, **llama_kwargs)
+            for _ in range(workers)
+        ]
+
+    @property
+    def deterministic(self) -> bool:
+        """
+        True if the workers reset the RNG to a fixed seed, so the same prompt gets the same answer.
+        """
+        return self.seed > 0
+
+    async def start(self) -> None:
+        """
+        Starts every worker and waits until all models are loaded.
+        """
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+
+    async def warm_up(self, prompt: str) -> None:
+        """
+        Generates a single token on every worker.
+        The first generation is slow because the model is read from disk, this way no user has to wait for it.
+        """
+        async def generate(worker: LLMWorker) -> None:
+            async for _ in worker.stream(prompt, max_tokens=1):
+                pass
+
+        await asyncio.gather(*(generate(worker) for worker in self.workers))
+
+    def stop(self) -> None:
+        for worker in self.workers:
+            worker.stop()
+
+    def set_prefix(self, prefix: str) -> None:
+        for worker in self.workers:
+            worker.set_prefix(prefix)
+
+    async def stream(self, prompt: str, **kwargs):
+        """
+        Generates a completion on the least loaded worker that is still running. See LLMWorker.stream.
+        """
+        workers = [worker for worker in self.workers if worker.alive]
+        if not workers:
+            raise RuntimeError("The generation failed: No LLM worker is running.")
+        worker = min(workers, key=lambda worker: worker.load)
+        async with contextlib.aclosing(worker.stream(prompt, **kwargs)) as fragments:
+            async for fragment in fragments:
+                yield fragment
+
+def _serve(llama_kwargs: dict, prefix: str, cache_folder: str, jobs, results, cancels) -> None:
+    """
+    The worker loop. Runs on the worker thread or as the main function of the worker process.
+    Loads the model and then works through the jobs one by one.
+    """
+    try:
+        llm = Llama(**llama_kwargs)
+        prompt_cache = PromptCache(llm, llama_kwargs["model_path"], cache_folder)
+        prompt_cache.set_prefix(prefix)
+    except Exception as e:
+        results.put((None, "loaded", str(e)))
+        return
+    results.put((None, "loaded", None))
+
+    cancelled = set()
+    while True:
+        job = jobs.get()
+        if job is None:
+            results.put((None, "stopped", None))
+            return
+
+        if job[0] == "prefix":
+            try:
+                prompt_cache.set_prefix(job[1])
+            except Exception as e:
+                print(f"The prompt cache could not be updated: {str(e)}")
+            continue
+
+        _, job_id, prompt, kwargs = job
+        _collect_cancels(cancels, cancelled)
+        if job_id in cancelled:
+            cancelled.discard(job_id)
+            results.put((job_id, "end", None))
+            continue
+
+        started_at = time.monotonic()
+        first_token_at = None
+        tokens = 0
+        try:
+            prompt_cache.restore()
+            if llama_kwargs.get("seed", 0) > 0:
+                # A fixed seed only gives reproducible answers if the RNG starts fresh for every generation
+                llama_cpp.llama_set_rng_seed(llm.ctx, llama_kwargs["seed"])
+            stream = llm(prompt, stream=True, **kwargs)
+            for output in stream:
+                # The prompt is evaluated before the first token comes out
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                tokens += 1
+                _collect_cancels(cancels, cancelled)
+                if job_id in cancelled:
+                    stream.close()
+                    break
+                results.put((job_id, "fragment", output["choices"][0]["text"]))
+
+            finished_at = time.monotonic()
+            first_token_at = first_token_at or finished_at
+            result = (job_id, "end", {"prompt_eval": first_token_at - started_at, "generation": finished_at - first_token_at, "tokens": tokens})
+        except Exception as e:
+            result = (job_id, "error", str(e))
+
+        # Cancels can arrive after a job ended, they are not needed anymore
+        cancelled = {cancelled_id for cancelled_id in cancelled if cancelled_id > job_id}
+        results.put(result)
+
+def _collect_cancels(cancels, cancelled: set) -> None:
+    """
+    Moves the cancelled job IDs from the cancel queue into the set.
+    """
+    while True:
+        try:
+            cancelled.add(cancels.get_nowait())
+        except queue.Empty:
+            return
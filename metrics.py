@@ -0,0 +1,182 @@
+from aiohttp import web
+from collections import deque
+from typing import Callable
+
+import json
+import logging
+import time
+import uuid
+
+logger = logging.getLogger("darkai")
+
+# Upper bounds in seconds
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+def _format_labels(label_key: tuple, extra: dict | None = None) -> str:
+    labels = dict(label_key)
+    if extra:
+        labels.update(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in labels.items()) + "}"
+
+class Counter:
+    """
+    A value that only goes up, for example the amount of Discord edits.
+    """
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    """
+    Counts observations in buckets, for example durations.
+    The newest observations are kept for the percentiles in the summary.
+    """
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}  # Label key -> [bucket counts, sum, count, recent observations]
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0, deque(maxlen=500)]
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+        series[3].append(value)
+
+    def percentile(self, percent: float, **labels) -> float:
+        series = self.series.get(_label_key(labels))
+        if series is None or not series[3]:
+            return 0.0
+        values = sorted(series[3])
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+    def count(self, **labels) -> int:
+        series = self.series.get(_label_key(labels))
+        return series[2] if series else 0
+
+    def average(self, **labels) -> float:
+        series = self.series.get(_label_key(labels))
+        return series[1] / series[2] if series and series[2] else 0.0
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (bucket_counts, total, count, _) in self.series.items():
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': bound})} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, {'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+class Gauge:
+    """
+    A value that is read when the metrics are rendered, for example the queue depth.
+    """
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], float]):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+class Metrics:
+    """
+    Collects the metrics of the bot and renders them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], float]) -> Gauge:
+        self._metrics[name] = Gauge(name, help_text, read)
+        return self._metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> web.AppRunner:
+        """
+        Serves the metrics on http://host:port/metrics.
+
+        Returns:
+            The runner of the server. Call 'await runner.cleanup()' to stop it.
+        """
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+# The metrics of the bot
+metrics = Metrics()
+
+CHAT_TIME_TO_FIRST_TOKEN = metrics.histogram("darkai_chat_time_to_first_token_seconds", "Time from the mention to the first generated token")
+CHAT_PROMPT_EVAL = metrics.histogram("darkai_chat_prompt_eval_seconds", "Time llama.cpp took to evaluate the prompt")
+CHAT_GENERATION = metrics.histogram("darkai_chat_generation_seconds", "Time llama.cpp took to generate the answer after the prompt")
+CHAT_TOKENS_PER_SECOND = metrics.histogram("darkai_chat_tokens_per_second", "Generation speed of the answers", buckets=(1, 2, 5, 10, 20, 50, 100))
+CHAT_TOKENS = metrics.counter("darkai_chat_tokens_total", "Generated tokens")
+CHAT_REQUESTS = metrics.counter("darkai_chat_requests_total", "Chat requests by result")
+DISCORD_EDITS = metrics.counter("darkai_discord_edits_total", "Discord message edits while streaming answers")
+DISCORD_EDIT_DURATION = metrics.histogram("darkai_discord_edit_seconds", "Duration of a Discord message edit, including rate limit waits")
+SD_REQUEST_DURATION = metrics.histogram("darkai_sd_request_seconds", "Duration of Stable Diffusion API requests")
+SD_RETRIES = metrics.counter("darkai_sd_retries_total", "Stable Diffusion API requests that were sent again")
+SD_QUEUE_WAIT = metrics.histogram("darkai_sd_queue_wait_seconds", "Time an image waited in the image queue")
+IMAGE_SEND_DURATION = metrics.histogram("darkai_image_send_seconds", "Time it took to send an image to Discord")
+FILE_IO_DURATION = metrics.histogram("darkai_file_io_seconds", "Duration of file writes and reads")
+
+def new_trace_id() -> str:
+    """
+    Returns a new ID to follow a request through the logs.
+    """
+    return uuid.uuid4().hex[:12]
+
+def log_event(event: str, trace_id: str | None = None, **fields) -> None:
+    """
+    Writes a structured log line.
+
+    Args:
+        event (str): The name of the event.
+        trace_id (str | None): The ID of the request the event belongs to.
+        **fields: Additional values of the event.
+    """
+    logger.info(json.dumps({"event": event, "trace_id": trace_id, "time": time.time(), **fields}, default=str))
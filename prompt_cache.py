@@ -0,0 +1,137 @@
+from collections import deque
+from llama_cpp import Llama
+from llama_cpp.llama import LlamaState
+
+import ctypes
+import llama_cpp
+import hashlib
+import os
+import pickle
+
+class PromptCache:
+    """
+    Keeps the llama state after evaluating the static prompt prefix.
+
+    The state is restored before a generation whenever the model drifted away from the prefix,
+    so llama.cpp only has to evaluate the part of the prompt after the prefix.
+    Llama already reuses the longest common prefix with the previous generation,
+    so a growing chat history is extended incrementally as well.
+    The state is saved to disk, so a restart does not have to evaluate the prefix again.
+    """
+
+    def __init__(self, llm: Llama, model_path: str, cache_folder: str):
+        """
+        Args:
+            llm (Llama): The model. Must only be used from the thread that owns it.
+            model_path (str): The path of the model. Its size and modification time are part of the cache key.
+            cache_folder (str): The folder the state files are saved in.
+        """
+        self._llm = llm
+        self._model_path = model_path
+        self._cache_folder = cache_folder
+        self._prefix = None
+        self._prefix_tokens = []
+        self._state = None
+
+    def set_prefix(self, prefix: str) -> None:
+        """
+        Evaluates the prefix, or loads its state from disk, and restores it.
+        Setting the same prefix again only restores the saved state.
+        """
+        if prefix != self._prefix:
+            self._prefix = prefix
+            self._prefix_tokens = self._llm.tokenize(prefix.encode("utf-8"))
+            self._state = self._load() or self._evaluate()
+        self._llm.load_state(self._state)
+
+    def restore(self) -> None:
+        """
+        Restores the prefix state if the model no longer starts with the prefix.
+        Must be called before every generation.
+        """
+        if self._state is None:
+            return
+
+        eval_tokens = list(self._llm.eval_tokens)[:len(self._prefix_tokens)]
+        if eval_tokens != self._prefix_tokens:
+            self._llm.load_state(self._state)
+
+    def _evaluate(self) -> LlamaState:
+        """
+        Evaluates the prefix from scratch and saves the state to disk.
+        """
+        self._llm.reset()
+        self._llm.eval(self._prefix_tokens)
+        state = self._llm.save_state()
+
+        try:
+            self._save(state)
+        except OSError as e:
+            print(f"The prompt cache could not be saved: {str(e)}")
+
+        return state
+
+    def _path(self) -> str:
+        """
+        Returns the path of the state file. The name depends on everything that changes the state.
+        A new model file at the same path gets a new name, its state does not fit the old one.
+        """
+        try:
+            stat = os.stat(self._model_path)
+            model_file = f"{stat.st_size}\n{stat.st_mtime_ns}"
+        except OSError:
+            model_file = ""
+        key = hashlib.sha256(f"{self._model_path}\n{model_file}\n{self._llm.params.n_ctx}\n{self._prefix}".encode("utf-8")).hexdigest()
+        return os.path.join(self._cache_folder, f"{key}.state")
+
+    def _load(self) -> LlamaState | None:
+        """
+        Loads the state of the prefix from disk.
+
+        Returns:
+            The state, or None if there is no valid state file.
+        """
+        try:
+            with open(self._path(), "rb") as state_file:
+                data = pickle.load(state_file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+        if data["eval_tokens"] != self._prefix_tokens:
+            return None
+        # llama.cpp reads as many bytes as the state of the loaded model has
+        state_size = llama_cpp.llama_get_state_size(self._llm.ctx)
+        if data["llama_state_size"] != state_size or len(data["llama_state"]) < state_size:
+            return None
+
+        llama_state = (ctypes.c_uint8 * data["llama_state_size"]).from_buffer_copy(data["llama_state"])
+        return LlamaState(
+            eval_tokens=deque(data["eval_tokens"], maxlen=self._llm.eval_tokens.maxlen),
+            eval_logits=deque(data["eval_logits"], maxlen=self._llm.eval_logits.maxlen),
+            llama_state=llama_state,
+            llama_state_size=data["llama_state_size"],
+        )
+
+    def _save(self, state: LlamaState) -> None:
+        """
+        Saves the state to disk and removes the state files of older prefixes.
+        """
+        os.makedirs(self._cache_folder, exist_ok=True)
+        path = self._path()
+
+        data = {
+            "eval_tokens": list(state.eval_tokens),
+            "eval_logits": list(state.eval_logits),
+            "llama_state": bytes(state.llama_state),
+            "llama_state_size": state.llama_state_size,
+        }
+        # Several worker processes can save the same state at once
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as state_file:
+            pickle.dump(data, state_file)
+        os.replace(temporary_path, path)
+
+        for file_name in os.listdir(self._cache_folder):
+            old_path = os.path.join(self._cache_folder, file_name)
+            if file_name.endswith(".state") and old_path != path:
+                os.remove(old_path)
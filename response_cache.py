@@ -0,0 +1,161 @@
+from collections import OrderedDict
+
+import asyncio
+import hashlib
+import json
+import time
+
+class SharedGenerationFailed(Exception):
+    """
+    Raised to the listeners of a shared generation that failed or was cancelled.
+    """
+    pass
+
+class SharedGeneration:
+    """
+    A running generation that several chat requests listen to.
+    Late listeners get every fragment generated so far first.
+    """
+
+    def __init__(self):
+        self.fragments = []
+        self.done = False
+        self.error = None  # Why the generation did not complete, None if it did
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def push(self, fragment: str) -> None:
+        """
+        Adds a generated fragment.
+        """
+        self.fragments.append(fragment)
+        self._changed.set()
+
+    def finish(self, error: str | None = None) -> None:
+        """
+        Marks the generation as done.
+
+        Args:
+            error (str | None): Why the generation did not complete. None if it did.
+        """
+        self.error = error
+        self.done = True
+        self._changed.set()
+
+    async def subscribe(self):
+        """
+        Yields the fragments of the generation until it is done.
+
+        Raises:
+            SharedGenerationFailed: If the generation failed or was cancelled.
+        """
+        self.subscribers += 1
+        try:
+            index = 0
+            while True:
+                while index < len(self.fragments):
+                    yield self.fragments[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise SharedGenerationFailed(self.error)
+                    return
+                self._changed.clear()
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+
+class ResponseCache:
+    """
+    Caches the answers of the LLM in deterministic mode.
+    With a fixed seed the same question gives the same answer, so repeated questions don't need the LLM.
+    Identical questions that arrive while the answer is still generated share the running generation.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        """
+        Args:
+            max_entries (int): The maximum amount of cached answers. The least recently used are removed first.
+            ttl (float): The amount of seconds an answer stays cached.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # Key -> (answer, time it was cached)
+        self._in_flight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(prefix: str, question: str, params: dict, model_path: str, seed: int) -> str:
+        """
+        Returns the cache key of a generation.
+        The chat history is not part of the key. It changes with every answer, so a repeated question could never hit the cache.
+        A cached answer was therefore generated after a different history than the one of the current channel.
+
+        Args:
+            prefix (str): The static prompt prefix.
+            question (str): The user's line of the prompt, including the user name.
+            params (dict): The sampling parameters (max_tokens, temperature, stop, ...).
+            model_path (str): The path of the model.
+            seed (int): The seed of the model.
+        """
+        return hashlib.sha256(json.dumps({"prefix": prefix, "question": question, "params": params, "model": model_path, "seed": seed}, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """
+        Returns the cached answer, or None if the answer is not cached or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def join(self, key: str) -> SharedGeneration | None:
+        """
+        Returns the running generation for the key, or None if there is none.
+        """
+        generation = self._in_flight.get(key)
+        if generation is not None:
+            self.coalesced += 1
+        return generation
+
+    def start(self, key: str) -> SharedGeneration:
+        """
+        Registers a new generation, so identical requests can join it.
+        """
+        generation = SharedGeneration()
+        self._in_flight[key] = generation
+        return generation
+
+    def finish(self, key: str, generation: SharedGeneration, answer: str | None, error: str | None = None) -> None:
+        """
+        Ends a generation and caches the answer.
+
+        Args:
+            answer (str | None): The answer to cache. None if it must not be cached.
+            error (str | None): Why the generation did not complete. The listeners get a SharedGenerationFailed.
+        """
+        generation.finish(error)
+        if self._in_flight.get(key) is generation:
+            del self._in_flight[key]
+
+        if answer:
+            self._entries[key] = (answer, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
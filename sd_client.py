@@ -0,0 +1,147 @@
+from metrics import SD_REQUEST_DURATION
+from metrics import SD_RETRIES
+
+import aiohttp
+import asyncio
+import time
+
+class SDAPIError(Exception):
+    """
+    Raised when the Stable Diffusion API returns an error or can not be reached.
+    """
+    pass
+
+class SDTimeoutError(SDAPIError):
+    """
+    Raised when a request to the Stable Diffusion API took longer than the timeout.
+    """
+    pass
+
+class SDClient:
+    """
+    An asynchronous client for the Stable Diffusion API (/sdapi/v1).
+    Keeps a pool of connections open and runs the requests without blocking the Discord gateway.
+    """
+
+    # Status codes that mean the API is (re)starting and the request can be sent again
+    RETRY_STATUSES = {502, 503, 504}
+
+    def __init__(self, url: str, timeout: float, retries: int, max_connections: int = 4):
+        """
+        Args:
+            url (str): The base URL of the API, for example http://127.0.0.1:7860.
+            timeout (float): The maximum amount of seconds a request may take.
+            retries (int): How often a request is sent again if the API can not be reached.
+            max_connections (int): The size of the connection pool.
+        """
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.max_connections = max_connections
+        self._session = None
+        self._model_name = None
+        self._model_checked_at = 0.0
+        self._generations = 0  # txt2img calls that are running
+        self._interrupts = set()  # Keeps the interrupt tasks alive until they are done
+
+    async def txt2img(self, payload: dict) -> dict:
+        """
+        Generates images. Cancelling the call or a timeout also interrupts the generation on the API,
+        but only if no other txt2img call is running. The interrupt stops every generation on the API.
+
+        Args:
+            payload (dict): The txt2img payload.
+
+        Returns:
+            The API response with the base64 encoded images and the generation info.
+        """
+        self._generations += 1
+        try:
+            # The API may already be generating when the connection breaks, so the request is only sent again if it never reached the API
+            return await self._request("POST", "/sdapi/v1/txt2img", payload, idempotent=False)
+        except (asyncio.CancelledError, SDTimeoutError):
+            if self._generations == 1:
+                task = asyncio.create_task(self.interrupt())
+                self._interrupts.add(task)
+                task.add_done_callback(self._interrupts.discard)
+            raise
+        finally:
+            self._generations -= 1
+
+    async def options(self) -> dict:
+        """
+        Returns the current options of the API, for example the loaded checkpoint.
+        """
+        return await self._request("GET", "/sdapi/v1/options")
+
+    async def model_name(self, max_age: float = 60.0) -> str:
+        """
+        Returns the name of the loaded checkpoint.
+        The name is only fetched again after 'max_age' seconds.
+        """
+        if self._model_name is None or time.monotonic() - self._model_checked_at > max_age:
+            options = await self.options()
+            self._model_name = str(options.get("sd_model_checkpoint"))
+            self._model_checked_at = time.monotonic()
+        return self._model_name
+
+    async def interrupt(self) -> None:
+        """
+        Stops the current generation on the API.
+        """
+        try:
+            await self._request("POST", "/sdapi/v1/interrupt", retries=0)
+        except SDAPIError as e:
+            print(f"The image generation could not be interrupted: {str(e)}")
+
+    async def close(self) -> None:
+        """
+        Closes the connection pool.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        return self._session
+
+    async def _request(self, method: str, endpoint: str, payload: dict | None = None, retries: int | None = None, idempotent: bool = True) -> dict:
+        """
+        Sends a request to the API.
+        Requests that failed with a connection error or one of the RETRY_STATUSES are sent again with an increasing delay.
+        If 'idempotent' is False, a connection error only leads to a retry if the connection could not be opened at all,
+        because a broken connection does not tell whether the API already started working on the request.
+
+        Raises:
+            SDAPIError: If the API returned an error or could not be reached.
+        """
+        retries = self.retries if retries is None else retries
+        started_at = time.monotonic()
+        try:
+            return await self._send(method, endpoint, payload, retries, idempotent)
+        finally:
+            SD_REQUEST_DURATION.observe(time.monotonic() - started_at, endpoint=endpoint)
+
+    async def _send(self, method: str, endpoint: str, payload: dict | None, retries: int, idempotent: bool) -> dict:
+        retry_errors = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) if idempotent else aiohttp.ClientConnectorError
+        for attempt in range(retries + 1):
+            try:
+                # The URL and timeout are read for every request, so they can be changed while the bot runs
+                async with self._get_session().request(method, f"{self.url}{endpoint}", json=payload, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                    if response.status >= 400 and (response.status not in self.RETRY_STATUSES or attempt >= retries):
+                        raise SDAPIError(f"{endpoint} returned {response.status}: {await response.text()}")
+                    if response.status < 400:
+                        return await response.json()
+            except retry_errors as e:
+                if attempt >= retries:
+                    raise SDAPIError(f"{endpoint} could not be reached: {str(e)}") from e
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+                raise SDAPIError(f"{endpoint} failed, the connection broke: {str(e)}") from e
+            except asyncio.TimeoutError as e:
+                # A timed out generation is not sent again, it would most likely time out again
+                raise SDTimeoutError(f"{endpoint} timed out after {self.timeout} seconds") from e
+
+            SD_RETRIES.inc(endpoint=endpoint)
+            await asyncio.sleep(2 ** attempt)
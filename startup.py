@@ -0,0 +1,61 @@
+from typing import Awaitable
+
+import contextlib
+import time
+
+class StartupReport:
+    """
+    Measures the phases of the startup and remembers if the bot is ready to chat.
+    Phases can overlap, for example the model loads while the bot connects to Discord.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.phases = []  # (name, seconds after the start the phase began, duration)
+        self.ready = False
+        self.error = None
+        self._open = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Measures the code inside the with block as a phase.
+        """
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    async def run(self, name: str, awaitable: Awaitable):
+        """
+        Measures an awaitable as a phase and returns its result.
+        """
+        with self.phase(name):
+            return await awaitable
+
+    def begin(self, name: str) -> None:
+        """
+        Starts a phase that ends somewhere else, for example in another event listener.
+        """
+        self._open[name] = time.monotonic()
+
+    def finished(self) -> bool:
+        """
+        Returns True if no phase is running anymore.
+        """
+        return not self._open
+
+    def end(self, name: str) -> None:
+        began_at = self._open.pop(name, None)
+        if began_at is not None:
+            self.phases.append((name, began_at - self.started_at, time.monotonic() - began_at))
+
+    def format(self) -> str:
+        """
+        Returns the report, one line per phase.
+        """
+        lines = [f"Startup took {time.monotonic() - self.started_at:.2f}s:"]
+        for name, began, duration in sorted(self.phases, key=lambda phase: phase[1]):
+            lines.append(f"  {name:<20} {duration:>7.2f}s (started after {began:.2f}s)")
+        return "\n".join(lines)
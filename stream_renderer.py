@@ -0,0 +1,130 @@
+from metrics import DISCORD_EDIT_DURATION
+from metrics import DISCORD_EDITS
+from profanity_filter import profanity as pf
+
+import hikari
+import re
+import time
+
+# Whitespace that starts a new word
+_WORD_START = re.compile(r"\s+(?=\S)")
+
+class IncrementalCensor:
+    """
+    Censors a growing text without running the profanity filter over the whole text every time.
+    Only the newest words are checked again. Older words are censored once and then kept.
+    """
+
+    def __init__(self):
+        self._raw = ""
+        self._committed_length = 0  # Length of the raw text that is already censored for good
+        self._committed = ""
+        self._censored = ""
+
+    @property
+    def text(self) -> str:
+        """
+        The censored text.
+        """
+        return self._censored
+
+    def feed(self, fragment: str) -> str:
+        """
+        Appends a fragment to the text.
+
+        Args:
+            fragment (str): The new text.
+
+        Returns:
+            The censored text.
+        """
+        self._raw += fragment
+        tail = self._raw[self._committed_length:]
+        censored_tail = pf.censor(tail)
+        self._censored = self._committed + censored_tail
+
+        # Swear words can span several words, so the last few words stay open for the next fragments
+        window = pf.max_number_combinations + 1
+        word_starts = [match.end() for match in _WORD_START.finditer(tail)]
+        if len(word_starts) > window:
+            boundary = word_starts[-window]
+            censored_head = pf.censor(tail[:boundary])
+            # Only commit if no swear word crosses the boundary
+            if censored_head + pf.censor(tail[boundary:]) == censored_tail:
+                self._committed += censored_head
+                self._committed_length += boundary
+
+        return self._censored
+
+class StreamRenderer:
+    """
+    Shows a streamed answer in a Discord message.
+    Fragments are collected and written with a single edit once the time or token budget is used up,
+    so an answer takes a handful of REST calls instead of one per token.
+    """
+
+    def __init__(self, rest: hikari.api.RESTClient, message: hikari.Message, suffix: str = "", interval: float = 1.0, token_budget: int = 20):
+        """
+        Args:
+            rest (hikari.api.RESTClient): The REST client used to edit the message.
+            message (hikari.Message): The message that shows the answer.
+            suffix (str): Text appended to every edit.
+            interval (float): The minimum amount of seconds between two edits.
+            token_budget (int): Edit early once this many tokens arrived since the last edit.
+        """
+        self._rest = rest
+        self._message = message
+        self._suffix = suffix
+        self._interval = interval
+        self._token_budget = token_budget
+        self._censor = IncrementalCensor()
+        self._pending_tokens = 0
+        self._last_edit = time.monotonic()
+        self._last_content = message.content
+        self.edits = 0
+
+    @property
+    def text(self) -> str:
+        """
+        The censored answer so far.
+        """
+        return self._censor.text
+
+    async def feed(self, fragment: str) -> None:
+        """
+        Adds a generated fragment and edits the message if the budget is used up.
+        """
+        self._censor.feed(fragment)
+        self._pending_tokens += 1
+
+        if self._pending_tokens >= self._token_budget or time.monotonic() - self._last_edit >= self._interval:
+            if self.text != "":
+                await self._edit(self.text)
+
+    async def finish(self, empty_text: str) -> hikari.Message:
+        """
+        Writes the final answer.
+
+        Args:
+            empty_text (str): The text shown if nothing was generated.
+
+        Returns:
+            The edited message.
+        """
+        await self._edit(self.text if self.text != "" else empty_text)
+        return self._message
+
+    async def _edit(self, text: str) -> None:
+        content = f"{text}{self._suffix}"
+        self._pending_tokens = 0
+        self._last_edit = time.monotonic()
+        if content == self._last_content:
+            return
+
+        # hikari waits for the rate limit inside edit_message, so the duration includes that wait
+        started_at = time.monotonic()
+        self._message = await self._rest.edit_message(self._message.channel_id, self._message.id, content=content)
+        DISCORD_EDIT_DURATION.observe(time.monotonic() - started_at)
+        DISCORD_EDITS.inc()
+        self._last_content = content
+        self.edits += 1